@@ -27,6 +27,24 @@ contract KaraokeToken is ERC721, ERC721URIStorage, ERC721Burnable, Ownable {
         _setTokenURI(tokenId, uri);
     }
 
+    // Mints one token per (to[i], uris[i]) pair in a single transaction,
+    // token ids are consecutive starting at firstTokenId.
+    function safeMintBatch(
+        address[] calldata to,
+        string[] calldata uris
+    ) public onlyOwner returns (uint256 firstTokenId) {
+        require(to.length == uris.length, "KaraokeToken: to and uris lengths differ");
+
+        firstTokenId = tokenCount.current();
+        for (uint256 i = 0; i < to.length; i++) {
+            uint256 tokenId = tokenCount.current();
+            tokenCount.increment();
+
+            _safeMint(to[i], tokenId);
+            _setTokenURI(tokenId, uris[i]);
+        }
+    }
+
     // The following functions are overrides required by Solidity.
 
     function tokenURI(uint256 tokenId)
@@ -0,0 +1,201 @@
+"""
+Speech recognition engines for process_audio, chosen by ASR_BACKEND:
+
+    whisper: openai-whisper, the default, tuned by WHISPER_PROFILE.
+    faster-whisper: the same Whisper models on CTranslate2, several times
+        faster on CPUs (pip install faster-whisper).
+
+A backend only turns 16 kHz float32 PCM into raw text, normalizing and
+caching transcripts is left to process_audio so every engine shares them.
+"""
+
+import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ASR_BACKEND = os.getenv('ASR_BACKEND') or 'whisper'
+
+# tiny.en, base.en, small.en or medium.en
+WHISPER_MODEL = os.getenv('WHISPER_MODEL') or 'medium.en'
+
+# Whisper inference profiles. 'default' runs the model as loaded, 'cpu-int8'
+# is for CPU-only hosts: linear layers dynamically quantized to int8, and
+# greedy decoding without the temperature fallback, which re-decodes short
+# sung lines that look repetitive. WHISPER_QUANTIZE ('int8' or 'none'),
+# WHISPER_THREADS, WHISPER_BEAM_SIZE and WHISPER_TEMPERATURE_FALLBACK
+# override single settings of the profile. faster-whisper takes the decoding
+# settings, its weights are quantized as FASTER_WHISPER_COMPUTE_TYPE says.
+WHISPER_PROFILES = {
+    'default': {'quantize': 'none', 'beam_size': 0, 'temperature_fallback': True},
+    'cpu-int8': {'quantize': 'int8', 'beam_size': 0, 'temperature_fallback': False},
+}
+WHISPER_PROFILE = os.getenv('WHISPER_PROFILE') or 'default'
+WHISPER_QUANTIZE = os.getenv('WHISPER_QUANTIZE') or WHISPER_PROFILES[WHISPER_PROFILE]['quantize']
+# intra-op threads of each process running the model, 0 for one per core
+WHISPER_THREADS = int(os.getenv('WHISPER_THREADS') or 0)
+# 0 decodes greedily
+WHISPER_BEAM_SIZE = int(os.getenv('WHISPER_BEAM_SIZE') or WHISPER_PROFILES[WHISPER_PROFILE]['beam_size'])
+WHISPER_TEMPERATURE_FALLBACK = (
+    os.getenv('WHISPER_TEMPERATURE_FALLBACK') or str(WHISPER_PROFILES[WHISPER_PROFILE]['temperature_fallback'])
+).lower() in ('1', 'true', 'yes')
+# int8, int8_float32, float32, or float16 on GPUs
+FASTER_WHISPER_COMPUTE_TYPE = os.getenv('FASTER_WHISPER_COMPUTE_TYPE') or 'int8'
+
+# whisper.transcribe's defaults, which the batched path checks its results against
+COMPRESSION_RATIO_THRESHOLD = 2.4
+LOGPROB_THRESHOLD = -1.0
+NO_SPEECH_THRESHOLD = 0.6
+
+
+def _quantize_int8(model):
+    """Dynamically quantizes the linear layers of a Whisper model on the CPU to int8."""
+    import torch
+
+    # Whisper's Linear subclass only casts its weights to the input's dtype,
+    # and quantize_dynamic only swaps modules of exactly the listed types
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class WhisperBackend:
+    """openai-whisper in this process."""
+
+    name = 'whisper'
+
+    def __init__(self):
+        self.model = None
+
+    def params(self):
+        """The settings transcripts depend on, part of process_audio.FEATURE_PARAMS."""
+        return [self.name, WHISPER_MODEL, WHISPER_QUANTIZE, WHISPER_BEAM_SIZE, WHISPER_TEMPERATURE_FALLBACK]
+
+    def load(self):
+        import torch
+        import whisper
+
+        if WHISPER_THREADS:
+            torch.set_num_threads(WHISPER_THREADS)
+
+        logging.info(f"loading whisper model {WHISPER_MODEL}, {WHISPER_PROFILE} profile")
+        if WHISPER_QUANTIZE == 'int8':
+            self.model = _quantize_int8(whisper.load_model(WHISPER_MODEL, device='cpu'))
+        else:
+            self.model = whisper.load_model(WHISPER_MODEL)
+        logging.info(f"whisper model {WHISPER_MODEL} loaded")
+
+    def _options(self):
+        """The keyword arguments of model.transcribe for the configured profile."""
+        options = {"fp16": self.model.device.type == "cuda", "beam_size": WHISPER_BEAM_SIZE or None}
+        if not WHISPER_TEMPERATURE_FALLBACK:
+            options["temperature"] = 0.0
+        return options
+
+    def transcribe(self, audio):
+        return self.model.transcribe(audio, **self._options())["text"]
+
+    def transcribe_batch(self, audios):
+        """
+        Clips that fit in Whisper's 30 second window are decoded together as
+        one padded batch at temperature 0, longer ones go through transcribe
+        one by one.
+
+        The batch gets the checks transcribe makes of each window: a clip
+        that decoded too repetitive or unlikely is transcribed again on its
+        own with the temperature fallback, if the profile has it, and one
+        that is most likely silence gets no text.
+        """
+        import torch
+        import whisper
+
+        texts = [None] * len(audios)
+
+        short = [i for i, audio in enumerate(audios) if len(audio) <= whisper.audio.N_SAMPLES]
+        for i, audio in enumerate(audios):
+            if i not in short:
+                texts[i] = self.transcribe(audio)
+
+        if short:
+            mel = torch.stack([
+                whisper.log_mel_spectrogram(whisper.pad_or_trim(torch.from_numpy(audios[i])), self.model.dims.n_mels)
+                for i in short
+            ]).to(self.model.device)
+            options = whisper.DecodingOptions(
+                language="en", without_timestamps=True, fp16=self.model.device.type == "cuda",
+                beam_size=WHISPER_BEAM_SIZE or None,
+            )
+            for i, result in zip(short, whisper.decode(self.model, mel, options)):
+                no_speech = result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD
+                needs_fallback = (
+                    result.compression_ratio > COMPRESSION_RATIO_THRESHOLD or result.avg_logprob < LOGPROB_THRESHOLD
+                )
+                if WHISPER_TEMPERATURE_FALLBACK and needs_fallback and not no_speech:
+                    texts[i] = self.transcribe(audios[i])
+                else:
+                    texts[i] = '' if no_speech else result.text
+
+        return texts
+
+    def transcribe_words(self, audio):
+        result = self.model.transcribe(audio, word_timestamps=True, **self._options())
+        return [
+            (word["word"], word["start"], word["end"])
+            for segment in result["segments"]
+            for word in segment.get("words", [])
+        ]
+
+
+class FasterWhisperBackend:
+    """faster-whisper (CTranslate2) on the CPU, or a GPU if there is one."""
+
+    name = 'faster-whisper'
+
+    def __init__(self):
+        self.model = None
+
+    def params(self):
+        return [self.name, WHISPER_MODEL, FASTER_WHISPER_COMPUTE_TYPE, WHISPER_BEAM_SIZE, WHISPER_TEMPERATURE_FALLBACK]
+
+    def load(self):
+        from faster_whisper import WhisperModel
+
+        logging.info(f"loading faster-whisper model {WHISPER_MODEL}, {FASTER_WHISPER_COMPUTE_TYPE}")
+        self.model = WhisperModel(
+            WHISPER_MODEL, device='auto', compute_type=FASTER_WHISPER_COMPUTE_TYPE, cpu_threads=WHISPER_THREADS,
+        )
+        logging.info(f"faster-whisper model {WHISPER_MODEL} loaded")
+
+    def _segments(self, audio, **options):
+        if not WHISPER_TEMPERATURE_FALLBACK:
+            options['temperature'] = 0.0
+        segments, _ = self.model.transcribe(audio, language='en', beam_size=WHISPER_BEAM_SIZE or 1, **options)
+        # segments is a generator, decoding happens as it is consumed
+        return list(segments)
+
+    def transcribe(self, audio):
+        return ''.join(segment.text for segment in self._segments(audio))
+
+    def transcribe_batch(self, audios):
+        return [self.transcribe(audio) for audio in audios]
+
+    def transcribe_words(self, audio):
+        return [
+            (word.word, word.start, word.end)
+            for segment in self._segments(audio, word_timestamps=True)
+            for word in segment.words or []
+        ]
+
+
+ASR_BACKENDS = {backend.name: backend for backend in (WhisperBackend, FasterWhisperBackend)}
+
+
+def create_backend(name=ASR_BACKEND):
+    """Returns the named backend, its model not loaded yet."""
+    if name not in ASR_BACKENDS:
+        raise ValueError(f"unknown ASR_BACKEND {name}, one of {', '.join(ASR_BACKENDS)}")
+    return ASR_BACKENDS[name]()
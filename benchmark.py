@@ -0,0 +1,699 @@
+"""
+Benchmarks for the scoring hot paths, on synthetic sung lines.
+
+    python benchmark.py concat --lines 10 25 50 100
+    python benchmark.py features --minutes 0.5 1 4
+    python benchmark.py nft --renders 20
+    python benchmark.py vad --seconds 3 10 --silence 1.5
+    python benchmark.py reject --seconds 5
+    python benchmark.py asr --profiles default cpu-int8 faster-whisper:cpu-int8
+
+The suite times every stage cold (empty caches) and warm, each stage in a
+fresh process so its peak RSS is its own, and compares saved runs:
+
+    python benchmark.py --output base.json suite
+    python benchmark.py --output new.json suite
+    python benchmark.py compare base.json new.json
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+import librosa
+import numpy as np
+from pydub import AudioSegment
+from pydub.generators import Sine
+
+from ogg_opus import concatenate_ogg_opus
+
+
+def sung_line(seconds, frequency):
+    """Returns a synthetic sung line as Ogg/Opus bytes, like a Telegram voice message."""
+    segment = Sine(frequency, sample_rate=48000).to_audio_segment(duration=seconds * 1000, volume=-10)
+    out = io.BytesIO()
+    segment.set_channels(1).export(out, format='ogg', codec='libopus')
+    return out.getvalue()
+
+
+def sung_lines(count, seconds=3.0):
+    """Returns count distinct synthetic lines, cycling through a few pitches an octave higher each time round."""
+    frequencies = [220, 247, 262, 294, 330, 349, 392]
+    return [
+        sung_line(seconds, frequencies[i % len(frequencies)] * (1 + i // len(frequencies)))
+        for i in range(count)
+    ]
+
+
+def sung_pcm(seconds, sr=16000, note_seconds=0.5):
+    """Returns a synthetic melody as float32 PCM, a new note every note_seconds."""
+    frequencies = [220, 247, 262, 294, 330, 349, 392]
+    melody = AudioSegment.empty()
+    for i in range(int(np.ceil(seconds / note_seconds))):
+        melody += Sine(frequencies[i % len(frequencies)], sample_rate=sr).to_audio_segment(
+            duration=note_seconds * 1000, volume=-10,
+        ).fade_in(20).fade_out(20)
+    samples = np.array(melody.set_channels(1).get_array_of_samples(), dtype=np.float32) / 32768
+    return samples[:int(seconds * sr)]
+
+
+def _time(fn, *args, repeat=3):
+    """Returns the best wall time of fn(*args) over repeat runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _concatenate_pydub(recordings):
+    """The previous concatenation: decode every line, append one by one, re-encode."""
+    sound = AudioSegment.from_file(io.BytesIO(recordings[0]), format='ogg')
+    for recording in recordings[1:]:
+        sound += AudioSegment.from_file(io.BytesIO(recording), format='ogg')
+    out = io.BytesIO()
+    sound.export(out, format='ogg')
+    return out.getvalue()
+
+
+def _legacy_acoustic_features(y, sr):
+    """The previous feature extraction: piptrack, a per-bin Python loop, then beat_track on its own STFT."""
+    pitches, magnitudes = librosa.piptrack(y=y, sr=sr)
+    pitch_bins = [np.max(pitches[i]) for i in range(pitches.shape[0])]
+    pitch_track = [pitch for pitch in pitch_bins if pitch > 0]
+    average_pitch = np.mean(pitch_track) if pitch_track else 0
+    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
+    duration = librosa.get_duration(y=y, sr=sr)
+
+    if isinstance(tempo, np.ndarray):
+        tempo = float(tempo[0])
+
+    return {
+        "bpm": float(tempo),
+        "duration": duration,
+        "average_pitch": float(average_pitch),
+        "pitch_track": float(np.linalg.norm(np.array(pitch_track))),
+        "pitch_range": len(pitch_track),
+        "pitch_bins": np.array(pitch_bins, dtype=float).tolist(),
+    }
+
+
+def _legacy_generate_nft_image(score, song_title):
+    """The previous NFT rendering: open the base image, draw title and score, encode at full size."""
+    from PIL import Image, ImageDraw, ImageFont
+    from generate_nft import BASE_IMAGE, IMG_MAP, NFT_FONT, TEXT_COLOR
+
+    font = ImageFont.truetype(NFT_FONT, 200)
+    img = Image.open(IMG_MAP.get(song_title, BASE_IMAGE))
+    draw = ImageDraw.Draw(img)
+    offset = 212
+    for line in textwrap.wrap(song_title, width=13):
+        draw.text((212, offset), line, font=font, fill=TEXT_COLOR, stroke_width=7)
+        left, top, right, bottom = font.getbbox(line)
+        offset += bottom - top + 100
+    draw.text((212, 1812), f"Score: {score}", font=font, fill=TEXT_COLOR, stroke_width=7)
+    out = io.BytesIO()
+    img.save(out, format=img.format)
+    return out.getvalue()
+
+
+def check_features_match(expected, actual):
+    """Raises AssertionError if two feature dicts differ beyond float rounding."""
+    assert expected.keys() == actual.keys(), f"keys differ: {expected.keys()} != {actual.keys()}"
+    for key, value in expected.items():
+        assert np.allclose(value, actual[key], rtol=1e-5), f"{key} differs: {value} != {actual[key]}"
+
+
+def bench_features(minutes, repeat):
+    from process_audio import acoustic_features, SAMPLE_RATE
+
+    results = []
+    for length in minutes:
+        y = sung_pcm(length * 60, sr=SAMPLE_RATE)
+
+        check_features_match(_legacy_acoustic_features(y, SAMPLE_RATE), acoustic_features(y, SAMPLE_RATE))
+
+        legacy = _time(_legacy_acoustic_features, y, SAMPLE_RATE, repeat=repeat)
+        single = _time(acoustic_features, y, SAMPLE_RATE, repeat=repeat)
+        results.append({
+            'minutes': length,
+            'single_stft_s_per_minute': single / length,
+            'legacy_s_per_minute': legacy / length,
+            'speedup': legacy / single,
+        })
+        print(
+            f"{length:5} min: single STFT {single / length * 1000:8.1f} ms/min, "
+            f"legacy {legacy / length * 1000:8.1f} ms/min, speedup {legacy / single:.2f}x"
+        )
+    return results
+
+
+def bench_concat(line_counts, repeat):
+    results = []
+    for count in line_counts:
+        recordings = sung_lines(count)
+        stitched = _time(concatenate_ogg_opus, recordings, repeat=repeat)
+        pydub = _time(_concatenate_pydub, recordings, repeat=repeat)
+        results.append({
+            'lines': count,
+            'stitch_s': stitched,
+            'stitch_ms_per_line': stitched / count * 1000,
+            'pydub_s': pydub,
+            'pydub_ms_per_line': pydub / count * 1000,
+        })
+        print(
+            f"{count:4} lines: stitch {stitched * 1000:8.1f} ms ({stitched / count * 1000:.2f} ms/line), "
+            f"pydub {pydub * 1000:8.1f} ms ({pydub / count * 1000:.2f} ms/line)"
+        )
+    return results
+
+
+def bench_nft(renders, quality, size, repeat):
+    from generate_nft import NftRenderer
+
+    # a title without an image of its own renders on the background that is checked in
+    song_title = 'Deck the Halls (chorus)'
+    renderer = NftRenderer(quality=quality, size=size)
+    renderer.preload()
+
+    def render_all(render):
+        for score in range(renders):
+            render(score * 997, song_title)
+
+    legacy = _time(render_all, _legacy_generate_nft_image, repeat=repeat)
+    cached = _time(render_all, renderer.render, repeat=repeat)
+    results = {
+        'renders': renders,
+        'quality': quality,
+        'size': size,
+        'cached_renders_per_s': renders / cached,
+        'cached_bytes': len(renderer.render(99999, song_title)),
+        'legacy_renders_per_s': renders / legacy,
+        'legacy_bytes': len(_legacy_generate_nft_image(99999, song_title)),
+    }
+    print(
+        f"{renders} renders: cached {results['cached_renders_per_s']:.1f}/s ({results['cached_bytes']} bytes), "
+        f"legacy {results['legacy_renders_per_s']:.1f}/s ({results['legacy_bytes']} bytes)"
+    )
+    return [results]
+
+
+def padded_line(seconds, silence, sr=16000):
+    """
+    Returns a synthetic sung line as float32 PCM, like a voice note: silence
+    before and after, and a pause of the same length halfway through.
+    """
+    half = sung_pcm(seconds / 2, sr=sr)
+    pause = np.zeros(int(silence * sr), dtype=np.float32)
+    return np.concatenate([pause, half, pause, half, pause])
+
+
+def bench_vad(seconds, silence, repeat, transcribe):
+    """trim_silence on padded lines of each length, and optionally Whisper on the line before and after."""
+    from process_audio import get_transcriber, SAMPLE_RATE, trim_silence
+
+    model = get_transcriber() if transcribe else None
+
+    results = []
+    for length in seconds:
+        y = padded_line(length, silence, sr=SAMPLE_RATE)
+        trimmed, removed = trim_silence(y)
+        result = {
+            'seconds': len(y) / SAMPLE_RATE,
+            'removed_s': removed,
+            'removed_fraction': removed / (len(y) / SAMPLE_RATE),
+            'trim_s': _time(trim_silence, y, repeat=repeat),
+        }
+        line = (
+            f"{result['seconds']:5.1f}s line: removed {removed:4.1f}s ({result['removed_fraction']:.0%}) "
+            f"in {result['trim_s'] * 1000:6.1f} ms"
+        )
+        if model is not None:
+            result['transcribe_s'] = _time(model.transcribe, y, repeat=repeat)
+            result['transcribe_trimmed_s'] = _time(model.transcribe, trimmed, repeat=repeat)
+            line += f", transcribe {result['transcribe_s']:.2f}s -> {result['transcribe_trimmed_s']:.2f}s"
+        results.append(result)
+        print(line)
+    return results
+
+
+def silent_line(seconds):
+    """Returns a silent voice message as Ogg/Opus bytes."""
+    out = io.BytesIO()
+    AudioSegment.silent(duration=seconds * 1000, frame_rate=48000).set_channels(1).export(
+        out, format='ogg', codec='libopus',
+    )
+    return out.getvalue()
+
+
+def bench_reject(seconds):
+    """
+    Time to analyze a line against a reference slice of seconds, for lines
+    rejected up front and for a sung line, which is transcribed.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ['FEATURE_CACHE_DIR'] = os.path.join(cache_dir, 'audio_features')
+        os.environ['TRANSCRIPT_CACHE_DIR'] = os.path.join(cache_dir, 'lyrics')
+        from process_audio import complete_line, prepare_line, transcribe_batch
+
+        _scoring_setup()
+
+        def analyze(recording):
+            key, features, audio = prepare_line(recording, seconds)
+            if audio is not None:
+                features = complete_line(key, features, transcribe_batch([audio])[0])
+            return features
+
+        results = []
+        cases = (
+            ('silent', silent_line(seconds)),
+            ('too short', sung_line(seconds / 4, 330)),
+            ('sung', sung_line(seconds, 262)),
+        )
+        for case, recording in cases:
+            start = time.perf_counter()
+            features = analyze(recording)
+            elapsed = time.perf_counter() - start
+            results.append({'case': case, 'seconds': elapsed, 'rejected': features.get('rejected')})
+            print(f"{case:>10}: {elapsed * 1000:9.1f} ms, rejected: {features.get('rejected')}")
+    return results
+
+
+def reference_fixtures():
+    """
+    Returns [(name, PCM, lyrics)] of every line of the song catalog: the
+    line's slice of its song's reference track, where the reference index
+    aligned it, and the line's lyrics as the expected text.
+    """
+    from process_audio import SAMPLE_RATE, decode_audio
+    from reference_index import load_reference_index
+    from songs import SONG_REFERENCES, SONGS
+
+    index = load_reference_index()
+    fixtures = []
+    for song_id, reference_file in SONG_REFERENCES.items():
+        with open(reference_file, 'rb') as file:
+            y = decode_audio(file.read())
+        for i, (line, reference_line) in enumerate(zip(SONGS[song_id], index[song_id]['lines'])):
+            start, end = int(reference_line['start'] * SAMPLE_RATE), int(reference_line['end'] * SAMPLE_RATE)
+            fixtures.append((f'{song_id} {i + 1}', y[start:end], line['lyrics']))
+    return fixtures
+
+
+def load_fixtures(directory):
+    """
+    Returns [(name, PCM, expected text)] of the audio files in directory with
+    a .txt transcript beside them, or reference_fixtures() for 'reference'.
+    """
+    if directory == 'reference':
+        return reference_fixtures()
+
+    from process_audio import decode_audio
+
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        transcript = os.path.join(directory, f'{stem}.txt')
+        if extension == '.txt' or not os.path.exists(transcript):
+            continue
+        with open(os.path.join(directory, name), 'rb') as file:
+            data = file.read()
+        with open(transcript, 'r') as file:
+            fixtures.append((stem, decode_audio(data), file.read().strip()))
+    return fixtures
+
+
+def fixtures_sha256(fixtures):
+    """Identifies a fixture set, so runs on different sets aren't compared."""
+    digest = hashlib.sha256()
+    for name, audio, text in fixtures:
+        digest.update(name.encode())
+        digest.update(np.ascontiguousarray(audio, dtype=np.float32).tobytes())
+        digest.update(text.encode())
+    return digest.hexdigest()
+
+
+def _run_asr_profile(profile, threads, fixtures, repeat):
+    """
+    Transcribes the fixtures in batches like the scoring workers do, with one
+    [ASR_BACKEND:]WHISPER_PROFILE, in this (fresh) process.
+    """
+    backend, _, whisper_profile = profile.rpartition(':')
+    os.environ['ASR_BACKEND'] = backend or 'whisper'
+    os.environ['WHISPER_PROFILE'] = whisper_profile
+    if threads:
+        os.environ['WHISPER_THREADS'] = str(threads)
+
+    from jiwer import wer
+    from process_audio import get_transcriber, normalizer, SAMPLE_RATE, transcribe_batch
+    from transcription_service import TRANSCRIBE_MAX_BATCH
+
+    audios = [audio for _, audio, _ in fixtures]
+
+    start = time.perf_counter()
+    get_transcriber()
+    transcribe_batch(audios[:1])
+    setup = time.perf_counter() - start
+
+    best, texts = float('inf'), []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        texts = [
+            text
+            for i in range(0, len(audios), TRANSCRIBE_MAX_BATCH)
+            for text in transcribe_batch(audios[i:i + TRANSCRIBE_MAX_BATCH])
+        ]
+        best = min(best, time.perf_counter() - start)
+
+    return {
+        'profile': profile,
+        'threads': threads,
+        'fixtures': len(fixtures),
+        'audio_s': sum(len(audio) for audio in audios) / SAMPLE_RATE,
+        'setup_s': setup,
+        'seconds': best,
+        'wer': wer([normalizer(text) for _, _, text in fixtures], texts),
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+
+
+def bench_asr(profiles, threads, directory, repeat):
+    """
+    WER and transcription time of each ASR backend and profile on a fixed fixture set,
+    and the accuracy lost per unit of speedup against the first profile.
+    """
+    fixtures = load_fixtures(directory)
+    if not fixtures:
+        sys.exit(f"no fixtures in {directory}, add audio files with a .txt transcript of the same name")
+    digest = fixtures_sha256(fixtures)
+    print(f"{len(fixtures)} fixtures from {directory}, sha256 {digest}")
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for profile in profiles:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(_run_asr_profile, profile, threads, fixtures, repeat).result()
+        result['fixtures_sha256'] = digest
+
+        base = results[0] if results else result
+        result['speedup'] = base['seconds'] / result['seconds']
+        result['wer_change'] = result['wer'] - base['wer']
+        # WER points lost for each 1x of speedup gained
+        result['wer_points_per_speedup'] = (
+            result['wer_change'] * 100 / (result['speedup'] - 1) if result['speedup'] > 1 else None
+        )
+        results.append(result)
+
+        print(
+            f"{profile:>22}: {result['seconds']:7.2f}s for {result['audio_s']:.0f}s of audio "
+            f"({result['audio_s'] / result['seconds']:6.1f}x real time), WER {result['wer']:.1%}, "
+            f"peak RSS {result['peak_rss_mb']:.0f} MB"
+        )
+        if result is not base:
+            tradeoff = result['wer_points_per_speedup']
+            print(
+                f"{'':>22}  {result['speedup']:.2f}x faster than {base['profile']}, "
+                f"WER {result['wer_change'] * 100:+.1f} points"
+                + (f" ({tradeoff:+.2f} points per 1x speedup)" if tradeoff is not None else "")
+            )
+    return results
+
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def _cold_warm(fn, args_list, repeat):
+    """
+    Times a pass of fn over args_list, first against empty caches, then the
+    best of repeat passes once everything is cached.
+    """
+    start = time.perf_counter()
+    for args in args_list:
+        fn(*args)
+    cold = time.perf_counter() - start
+
+    def run_all():
+        for args in args_list:
+            fn(*args)
+
+    return cold, _time(run_all, repeat=repeat)
+
+
+def _result(stage, case, cold, warm, work, unit, **extra):
+    return {
+        'stage': stage,
+        'case': case,
+        'cold_s': cold,
+        'warm_s': warm,
+        'unit': unit,
+        'work': work,
+        f'cold_{unit}_per_s': work / cold,
+        f'warm_{unit}_per_s': work / warm,
+        **extra,
+    }
+
+
+def _scoring_setup():
+    """Loads the Whisper model and compiles librosa's JIT code, returns how long that took."""
+    from process_audio import acoustic_features, get_transcriber, SAMPLE_RATE
+
+    start = time.perf_counter()
+    get_transcriber()
+    acoustic_features(sung_pcm(1, sr=SAMPLE_RATE))
+    return time.perf_counter() - start
+
+
+def suite_extract(seconds, lines, repeat):
+    """_extract_features over lines distinct lines of each length."""
+    from process_audio import _extract_features
+
+    setup = _scoring_setup()
+
+    results = []
+    for length in seconds:
+        recordings = sung_lines(lines, length)
+        cold, warm = _cold_warm(_extract_features, [(recording,) for recording in recordings], repeat)
+        results.append(_result(
+            'extract', f'{lines}x{length}s', cold, warm, lines * length, 'audio_s', setup_s=setup,
+        ))
+    return results
+
+
+def suite_compare(seconds, repeat):
+    """compare_audios of two reference-like files of each length."""
+    from process_audio import compare_audios
+
+    setup = _scoring_setup()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for length in seconds:
+            files = []
+            for name, frequency in (('reference', 262), ('performance', 294)):
+                path = os.path.join(directory, f'{name}_{length}.ogg')
+                with open(path, 'wb') as file:
+                    file.write(sung_line(length, frequency))
+                files.append(path)
+            cold, warm = _cold_warm(compare_audios, [tuple(files)], repeat)
+            results.append(_result('compare', f'{length}s', cold, warm, 2 * length, 'audio_s', setup_s=setup))
+    return results
+
+
+def suite_concat(seconds, line_counts, repeat):
+    """concatenate_audio of performances of each line count."""
+    from process_audio import concatenate_audio
+
+    results = []
+    for count in line_counts:
+        recordings = sung_lines(count, seconds)
+        cold, warm = _cold_warm(concatenate_audio, [(recordings,)], repeat)
+        results.append(_result('concat', f'{count}x{seconds}s', cold, warm, count, 'lines'))
+    return results
+
+
+def suite_nft(renders, repeat):
+    """generate_nft_image of renders scores, the first pass building the title layer."""
+    from generate_nft import generate_nft_image
+
+    cold, warm = _cold_warm(generate_nft_image, [(score * 997, 'Silent Night') for score in range(renders)], repeat)
+    return [_result('nft', f'{renders} renders', cold, warm, renders, 'renders')]
+
+
+def _run_suite_stage(stage, kwargs, cache_dir):
+    """Runs one suite stage in this (fresh) process, with empty caches under cache_dir."""
+    os.environ['FEATURE_CACHE_DIR'] = os.path.join(cache_dir, 'audio_features')
+    os.environ['TRANSCRIPT_CACHE_DIR'] = os.path.join(cache_dir, 'lyrics')
+
+    stages = {'extract': suite_extract, 'compare': suite_compare, 'concat': suite_concat, 'nft': suite_nft}
+    results = stages[stage](**kwargs)
+    peak_rss = _peak_rss_mb()
+    for result in results:
+        result['stage_peak_rss_mb'] = peak_rss
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(args):
+    stages = {
+        'extract': {'seconds': args.seconds, 'lines': args.extract_lines, 'repeat': args.repeat},
+        'compare': {'seconds': args.seconds, 'repeat': args.repeat},
+        'concat': {'seconds': min(args.seconds), 'line_counts': args.lines, 'repeat': args.repeat},
+        'nft': {'renders': args.renders, 'repeat': args.repeat},
+    }
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for stage in args.stages:
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                stage_results = executor.submit(_run_suite_stage, stage, stages[stage], cache_dir).result()
+            except Exception as e:
+                print(f"{stage:8} failed: {e!r}")
+                results.append({'stage': stage, 'error': repr(e)})
+                continue
+
+        for result in stage_results:
+            unit = result['unit']
+            print(
+                f"{stage:8} {result['case']:>14}: cold {result['cold_s'] * 1000:9.1f} ms "
+                f"({result[f'cold_{unit}_per_s']:8.2f} {unit}/s), warm {result['warm_s'] * 1000:9.1f} ms "
+                f"({result[f'warm_{unit}_per_s']:8.2f} {unit}/s), peak RSS {result['stage_peak_rss_mb']:.0f} MB"
+            )
+        results.extend(stage_results)
+
+    return results
+
+
+def compare_runs(base_file, new_file, threshold):
+    """Prints how each stage of a run changed against a base run, returns the number of regressions."""
+    with open(base_file, 'r') as file:
+        base = json.load(file)
+    with open(new_file, 'r') as file:
+        new = json.load(file)
+
+    base_results = {(result['stage'], result.get('case')): result for result in base['results']}
+    print(f"{base.get('meta', {}).get('commit')} -> {new.get('meta', {}).get('commit')}")
+
+    regressions = 0
+    for result in new['results']:
+        key = (result['stage'], result.get('case'))
+        previous = base_results.get(key)
+        if previous is None or 'error' in result or 'error' in previous:
+            print(f"{key[0]:8} {str(key[1]):>14}: not comparable")
+            continue
+
+        changes = []
+        for metric in ('cold_s', 'warm_s', 'stage_peak_rss_mb'):
+            ratio = result[metric] / previous[metric] if previous[metric] else float('inf')
+            regressed = ratio > 1 + threshold
+            regressions += regressed
+            changes.append(f"{metric} {(ratio - 1) * 100:+6.1f}%{' REGRESSION' if regressed else ''}")
+        print(f"{key[0]:8} {key[1]:>14}: " + ', '.join(changes))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='stage', required=True)
+
+    concat = subparsers.add_parser('concat', help='concatenate_audio, stitched vs decode/append/encode')
+    concat.add_argument('--lines', type=int, nargs='+', default=[10, 25, 50, 100])
+
+    features = subparsers.add_parser('features', help='acoustic features, single STFT vs piptrack + beat_track')
+    features.add_argument('--minutes', type=float, nargs='+', default=[0.5, 1, 4])
+
+    nft = subparsers.add_parser('nft', help='NFT renders per second, cached title layers vs full redraw')
+    nft.add_argument('--renders', type=int, default=20)
+    nft.add_argument('--quality', type=int, default=75, help='JPEG quality of the cached renderer')
+    nft.add_argument('--size', type=int, default=0, help='longest side of the cached renderer output, 0 for full size')
+
+    vad = subparsers.add_parser('vad', help='silence trimmed from padded lines, and its effect on Whisper')
+    vad.add_argument('--seconds', type=float, nargs='+', default=[3, 10], help='sung length of the lines')
+    vad.add_argument('--silence', type=float, default=1.5, help='seconds of silence before, within and after each line')
+    vad.add_argument('--transcribe', action='store_true', help='also time Whisper on the lines before and after trimming')
+
+    reject = subparsers.add_parser('reject', help='analysis time of silent and too short lines vs a sung line')
+    reject.add_argument('--seconds', type=float, default=5, help='length of the reference slice and the sung line')
+
+    asr = subparsers.add_parser('asr', help='WER vs transcription time of ASR backends and profiles on a fixture set')
+    asr.add_argument('--profiles', nargs='+', default=['default', 'cpu-int8'],
+                     help='WHISPER_PROFILE values, optionally prefixed by an ASR_BACKEND and a colon, '
+                          'compared against the first')
+    asr.add_argument('--threads', type=int, default=0, help='WHISPER_THREADS, 0 for one per core')
+    asr.add_argument('--fixtures', default='reference',
+                     help="'reference' for every catalog line sliced from its reference track (see "
+                          "reference_index.py), or a directory of sung lines, each audio file with a .txt "
+                          "transcript of the same name")
+
+    suite = subparsers.add_parser('suite', help='every stage cold and warm, with throughput and peak RSS')
+    suite.add_argument('--stages', nargs='+', default=['extract', 'compare', 'concat', 'nft'],
+                       choices=['extract', 'compare', 'concat', 'nft'])
+    suite.add_argument('--seconds', type=float, nargs='+', default=[3, 10], help='lengths of the sung lines')
+    suite.add_argument('--extract-lines', type=int, default=5, help='lines of each length to extract')
+    suite.add_argument('--lines', type=int, nargs='+', default=[10, 50], help='line counts to concatenate')
+    suite.add_argument('--renders', type=int, default=10)
+
+    compare = subparsers.add_parser('compare', help='compare two saved suite runs')
+    compare.add_argument('base')
+    compare.add_argument('new')
+    compare.add_argument('--threshold', type=float, default=0.1, help='slowdown counted as a regression, 0.1 is 10%%')
+
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    if args.stage == 'concat':
+        results = bench_concat(args.lines, args.repeat)
+    elif args.stage == 'features':
+        results = bench_features(args.minutes, args.repeat)
+    elif args.stage == 'nft':
+        results = bench_nft(args.renders, args.quality, args.size, args.repeat)
+    elif args.stage == 'vad':
+        results = bench_vad(args.seconds, args.silence, args.repeat, args.transcribe)
+    elif args.stage == 'asr':
+        results = bench_asr(args.profiles, args.threads, args.fixtures, args.repeat)
+    elif args.stage == 'reject':
+        results = bench_reject(args.seconds)
+    elif args.stage == 'suite':
+        results = bench_suite(args)
+    elif args.stage == 'compare':
+        sys.exit(1 if compare_runs(args.base, args.new, args.threshold) else 0)
+
+    if args.output:
+        meta = {
+            'commit': _git_commit(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'argv': sys.argv[1:],
+        }
+        with open(args.output, 'w') as file:
+            json.dump({'stage': args.stage, 'meta': meta, 'results': results}, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 from ape import accounts, networks, Contract, project
 from ape.types import AddressType
-from web3 import Web3
+from web3 import AsyncWeb3, AsyncHTTPProvider
+from web3.exceptions import TimeExhausted
+from web3.logs import DISCARD
 from dotenv import load_dotenv
 
+import asyncio
+import heapq
 import json
+import logging
 import os
 
 load_dotenv()
@@ -22,40 +27,358 @@ PRIVATE_KEY = os.getenv('PRIVATE_KEY') or ''
 #CONTRACT_ADDRESS = "0xCB7b3F767D536b7F884f0342372D8dE6E577a1e2"
 
 
-# opBNB testnet
-CONTRACT_ADDRESS = "0xCB7b3F767D536b7F884f0342372D8dE6E577a1e2"
-NODE_URL = f"https://opbnb-testnet-rpc.bnbchain.org"
+# opBNB testnet, override both to point at a local dev chain (e.g. anvil)
+CONTRACT_ADDRESS = os.getenv('CONTRACT_ADDRESS') or "0xCB7b3F767D536b7F884f0342372D8dE6E577a1e2"
+NODE_URL = os.getenv('NODE_URL') or f"https://opbnb-testnet-rpc.bnbchain.org"
+
+# How long to wait for a receipt before replacing a transaction, and how many times
+RECEIPT_TIMEOUT_SECONDS = float(os.getenv('RECEIPT_TIMEOUT_SECONDS') or 120)
+MAX_REPLACEMENTS = int(os.getenv('MAX_REPLACEMENTS') or 2)
+# Replacements must raise the gas price by at least 10% to be accepted
+GAS_BUMP = 1.125
+
+# How long to collect mints before sending them as one safeMintBatch
+# transaction, and the most per transaction. 0 sends every mint on its own
+# through safeMint, for deployments of the contract without safeMintBatch.
+# A batch only ever holds the mints of the NFT jobs running at once, so
+# nft_jobs.NFT_JOB_CONCURRENCY defaults to MINT_BATCH_MAX.
+MINT_BATCH_WINDOW_MS = float(os.getenv('MINT_BATCH_WINDOW_MS') or 0)
+MINT_BATCH_MAX = int(os.getenv('MINT_BATCH_MAX') or 8)
+
+ZERO_ADDRESS = '0x0000000000000000000000000000000000000000'
+
+
+class NonceManager:
+    """
+    Hands out the caller's nonces locally, so concurrent mints never share one.
+
+    Every allocated nonce is outstanding until it is settled, its transaction
+    mined or at least known to the node, or released, its transaction never
+    broadcast or dropped. Released nonces are handed out again first, which
+    fills the gaps they left behind. The node's pending transaction count is
+    only read while nothing is outstanding, before that it can't count the
+    transactions still on their way.
+    """
+
+    def __init__(self, w3, address):
+        self.w3 = w3
+        self.address = address
+        self._next = None
+        self._free = []
+        self._outstanding = set()
+        self._lock = asyncio.Lock()
+
+    async def allocate(self):
+        async with self._lock:
+            if self._free:
+                nonce = heapq.heappop(self._free)
+            else:
+                if self._next is None:
+                    self._next = await self.w3.eth.get_transaction_count(self.address, 'pending')
+                nonce = self._next
+                self._next += 1
+            self._outstanding.add(nonce)
+            return nonce
+
+    def _done(self, nonce):
+        self._outstanding.discard(nonce)
+        if not self._outstanding:
+            # ask the node again next time, in case others sent from the address
+            self._next = None
+            self._free = []
+
+    async def settle(self, nonce):
+        """The nonce's transaction went through, or is pending on the node."""
+        async with self._lock:
+            self._done(nonce)
+
+    async def release(self, nonce):
+        """The nonce's transaction never reached the node or was dropped, hand it out again."""
+        async with self._lock:
+            if nonce in self._outstanding:
+                heapq.heappush(self._free, nonce)
+            self._done(nonce)
 
-def call_contract_mint(to_addr, nft_ipfs):
-    w3 = Web3(Web3.HTTPProvider(NODE_URL))
 
-    if w3.is_connected():
-        print('connected')
+class KaraokeContractClient:
+    """
+    A long-lived connection to the KaraokeToken contract.
 
-        # Initialize address nonce
-        nonce = w3.eth.get_transaction_count(CALLER)
+    Keeps one pooled AsyncWeb3 provider, the contract instance, the chain id
+    and a NonceManager for CALLER. Pass provider to use something other than
+    HTTP, e.g. web3's AsyncEthereumTesterProvider as a local chain.
+    """
+
+    def __init__(self, node_url=NODE_URL, contract_address=CONTRACT_ADDRESS, caller=CALLER, private_key=PRIVATE_KEY,
+                 provider=None):
+        self.w3 = AsyncWeb3(provider or AsyncHTTPProvider(node_url))
+        self.caller = caller
+        self.private_key = private_key
 
-        # Initialize contract ABI and address
         with open(CONTRACT_ABI_PATH, 'r') as f:
-            d = json.load(f)
-            abi = json.dumps(d)
+            abi = json.load(f)
+        self.contract = self.w3.eth.contract(address=contract_address, abi=abi)
+
+        self.nonces = NonceManager(self.w3, caller)
+        self._chain_id = None
+
+    async def chain_id(self):
+        if self._chain_id is None:
+            self._chain_id = await self.w3.eth.chain_id
+        return self._chain_id
+
+    async def _send(self, tx):
+        signed_tx = self.w3.eth.account.sign_transaction(tx, private_key=self.private_key)
+        try:
+            await self.w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+        except Exception as e:
+            # a resend of a transaction the node already has is fine
+            if 'already known' not in str(e):
+                raise
+        return signed_tx.hash
+
+    async def send_transaction(self, call_function, on_sent=None):
+        """
+        Signs and sends a contract call with a locally allocated nonce, returns its receipt.
+
+        If no receipt arrives within RECEIPT_TIMEOUT_SECONDS the transaction is
+        assumed dropped or underpriced and replaced, same nonce and a higher gas
+        price, up to MAX_REPLACEMENTS times. on_sent(tx_hash) is called for
+        every transaction sent, before waiting on it.
+        """
+        nonce = await self.nonces.allocate()
+        try:
+            tx = await call_function.build_transaction({
+                "chainId": await self.chain_id(),
+                "from": self.caller,
+                "nonce": nonce,
+            })
+            tx_hash = await self._send(tx)
+        except Exception:
+            await self.nonces.release(nonce)
+            raise
+
+        sent = [tx_hash]
+        try:
+            receipt = await self._wait_or_replace(tx, nonce, sent, on_sent)
+        except Exception:
+            await self._release_if_dropped(nonce, sent)
+            raise
+        await self.nonces.settle(nonce)
+        return receipt
+
+    async def _wait_or_replace(self, tx, nonce, sent, on_sent):
+        """Waits for the receipt of the last transaction in sent, replacing it if none comes."""
+        tx_hash = sent[-1]
+        for replacement in range(MAX_REPLACEMENTS + 1):
+            if on_sent:
+                on_sent(tx_hash.to_0x_hex())
+            try:
+                return await self.w3.eth.wait_for_transaction_receipt(tx_hash, timeout=RECEIPT_TIMEOUT_SECONDS)
+            except TimeExhausted:
+                if replacement == MAX_REPLACEMENTS:
+                    raise
+
+            logging.warning(f"no receipt for {tx_hash.to_0x_hex()} (nonce {nonce}), replacing it")
+            if 'maxFeePerGas' in tx:
+                tx['maxFeePerGas'] = int(tx['maxFeePerGas'] * GAS_BUMP) + 1
+                tx['maxPriorityFeePerGas'] = int(tx['maxPriorityFeePerGas'] * GAS_BUMP) + 1
+            else:
+                tx['gasPrice'] = int(tx['gasPrice'] * GAS_BUMP) + 1
+            try:
+                tx_hash = await self._send(tx)
+            except Exception as e:
+                # one of the earlier versions was mined in the meantime
+                if 'nonce too low' in str(e):
+                    for sent_hash in sent:
+                        receipt = await self.get_receipt(sent_hash)
+                        if receipt:
+                            return receipt
+                raise
+            sent.append(tx_hash)
+
+    async def _release_if_dropped(self, nonce, sent):
+        """
+        Releases a nonce none of whose transactions the node knows, e.g. dropped
+        from the mempool, so the next mint fills the gap instead of later mints
+        waiting behind it forever.
+        """
+        for sent_hash in sent:
+            if await self.is_known(sent_hash):
+                await self.nonces.settle(nonce)
+                return
+        logging.warning(f"node knows no transaction with nonce {nonce}, releasing it")
+        await self.nonces.release(nonce)
+
+    async def mint(self, to_addr, nft_ipfs, on_sent=None):
+        """Mints one NFT to to_addr, returns the transaction receipt."""
+        return await self.send_transaction(self.contract.functions.safeMint(to_addr, nft_ipfs), on_sent=on_sent)
 
+    async def mint_batch(self, to_addrs, nft_ipfs_list, on_sent=None):
+        """Mints one NFT per (to_addrs[i], nft_ipfs_list[i]) in a single transaction, returns its receipt."""
+        return await self.send_transaction(
+            self.contract.functions.safeMintBatch(to_addrs, nft_ipfs_list), on_sent=on_sent,
+        )
 
-        # Create smart contract instance
-        contract = w3.eth.contract(address=CONTRACT_ADDRESS, abi=abi)
+    def minted_tokens(self, receipt):
+        """Returns (to_addr, token_id) of every token a receipt minted, in mint order."""
+        events = self.contract.events.Transfer().process_receipt(receipt, errors=DISCARD)
+        return [
+            (event['args']['to'], event['args']['tokenId'])
+            for event in events
+            if event['address'] == self.contract.address and event['args']['from'] == ZERO_ADDRESS
+        ]
 
-        chain_id = w3.eth.chain_id
+    async def is_known(self, tx_hash):
+        """Returns whether the node still knows a transaction, mined or pending."""
+        try:
+            return await self.w3.eth.get_transaction(tx_hash) is not None
+        except Exception:
+            return False
 
-        call_function = contract.functions.safeMint(to_addr, nft_ipfs).build_transaction({"chainId": chain_id, "from": CALLER, "nonce": nonce})
+    async def get_receipt(self, tx_hash):
+        """Returns the receipt of a sent transaction, or None if it isn't mined (yet)."""
+        try:
+            return await self.w3.eth.get_transaction_receipt(tx_hash)
+        except Exception:
+            return None
 
-        signed_tx = w3.eth.account.sign_transaction(call_function, private_key=PRIVATE_KEY)
 
-        send_tx = w3.eth.send_raw_transaction(signed_tx.raw_transaction)
+class MintBatcher:
+    """
+    Collects mints for up to window seconds and sends them as one safeMintBatch.
 
-        tx_receipt = w3.eth.wait_for_transaction_receipt(send_tx)
+    A batch goes out once window has passed since its first mint, or right
+    away once it holds max_batch mints. Every mint of a batch shares its
+    transaction, on_sent of each is called with the transaction hash. With a
+    window of 0 every mint is sent on its own through safeMint.
+
+    One bad mint, e.g. to a contract that refuses tokens, fails the whole
+    safeMintBatch. A batch that reverted or never went out is sent again
+    mint by mint, so only that mint fails.
+    """
+
+    def __init__(self, client, window=MINT_BATCH_WINDOW_MS / 1000, max_batch=MINT_BATCH_MAX):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._sending = set()
+
+    async def mint(self, to_addr, nft_ipfs, on_sent=None):
+        """
+        Mints one NFT to to_addr, returns (receipt, token_id).
+
+        token_id is None if the transaction reverted or its token can't be
+        told apart in the receipt.
+        """
+        if self.window <= 0:
+            receipt = await self.client.mint(to_addr, nft_ipfs, on_sent=on_sent)
+            return receipt, self._token_ids(receipt, 1)[0]
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((to_addr, nft_ipfs, on_sent, future))
+        if len(self._pending) >= self.max_batch:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send_batch(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _token_ids(self, receipt, count):
+        token_ids = []
+        if receipt['status'] == 1:
+            token_ids = [token_id for _, token_id in self.client.minted_tokens(receipt)]
+        if len(token_ids) != count:
+            token_ids = []
+        return token_ids + [None] * (count - len(token_ids))
+
+    async def _send_batch(self, batch):
+        sent = []
+
+        def on_sent(tx_hash):
+            sent.append(tx_hash)
+            for _, _, callback, _ in batch:
+                if callback is None:
+                    continue
+                try:
+                    callback(tx_hash)
+                except Exception:
+                    logging.exception(f"on_sent callback failed for {tx_hash}")
+
+        try:
+            if len(batch) == 1:
+                to_addr, nft_ipfs, _, _ = batch[0]
+                receipt = await self.client.mint(to_addr, nft_ipfs, on_sent=on_sent)
+            else:
+                logging.info(f"minting a batch of {len(batch)} nfts")
+                receipt = await self.client.mint_batch(
+                    [to_addr for to_addr, _, _, _ in batch],
+                    [nft_ipfs for _, nft_ipfs, _, _ in batch],
+                    on_sent=on_sent,
+                )
+        except Exception as e:
+            # failed before it was broadcast, e.g. the gas estimate reverted
+            if len(batch) > 1 and not sent:
+                logging.warning(f"batch of {len(batch)} nfts failed before it was sent ({e}), minting one by one")
+                await self._send_one_by_one(batch)
+                return
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(batch) > 1 and receipt['status'] != 1:
+            logging.warning(f"batch of {len(batch)} nfts reverted in {sent[-1]}, minting one by one")
+            await self._send_one_by_one(batch)
+            return
+
+        for (_, _, _, future), token_id in zip(batch, self._token_ids(receipt, len(batch))):
+            if not future.done():
+                future.set_result((receipt, token_id))
+
+    async def _send_one_by_one(self, batch):
+        """Sends each mint of a batch that minted nothing through safeMint."""
+        await asyncio.gather(*(self._send_batch([mint]) for mint in batch))
+
+
+_CLIENT = None
+_BATCHER = None
+
+
+def get_contract_client():
+    """Returns the shared KaraokeContractClient, created on first use."""
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = KaraokeContractClient()
+    return _CLIENT
+
+
+def get_mint_batcher():
+    """Returns the shared MintBatcher on top of get_contract_client(), created on first use."""
+    global _BATCHER
+    if _BATCHER is None:
+        _BATCHER = MintBatcher(get_contract_client())
+    return _BATCHER
+
+
+def call_contract_mint(to_addr, nft_ipfs):
+    """
+    Mints one NFT and waits for the receipt, for use outside an event loop.
 
-        return tx_receipt
-    else:
-        print('connection failed')
+    Uses a client of its own, the bot goes through get_contract_client().
+    """
+    return asyncio.run(KaraokeContractClient().mint(to_addr, nft_ipfs))
 
 #call_contract_mint('0x76edf74606cF1b3E2FE7C4670544adE6010C3E56', 'ipfs://QmQGSnjkc3Z7wqsdRt1XMyX5apvYLezbA4GdS9hByfXxEN')
@@ -0,0 +1,152 @@
+"""
+Content-addressed on-disk cache for transcripts and audio features.
+
+Entries are keyed by a hash of the encoded audio plus the feature version, so
+two recordings never share an entry and results from an older model or
+parameter set are never returned. Each cache directory is capped in size and
+evicts its least recently used entries.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from metrics import inc
+
+# Other processes write to the same directories, the size kept in memory is
+# re-read from disk every this many puts so their entries count too
+SIZE_RESYNC_PUTS = 32
+
+
+def content_hash(data):
+    """Returns the sha256 of audio bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class FeatureCache:
+    """
+    A directory of JSON entries, capped at max_bytes.
+
+    Hits refresh an entry's mtime, eviction removes the oldest mtimes first.
+    Writes go to a temporary file that is renamed into place, so readers in
+    other processes never see partial entries.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        # label of this cache's hit and miss counters
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    def key(self, data, version):
+        """Returns the cache key of encoded audio bytes for a feature version."""
+        return f'{content_hash(data)}-{version}'
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        """Returns the cached value for key, or None."""
+        path = self._path(key)
+        try:
+            with open(path, 'r') as file:
+                value = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            inc('karaoke_cache_requests_total', cache=self.name, result='miss')
+            return None
+
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            self.hits += 1
+        inc('karaoke_cache_requests_total', cache=self.name, result='hit')
+        return value
+
+    def put(self, key, value):
+        """Atomically stores value under key, then evicts if over the size cap."""
+        os.makedirs(self.directory, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as file:
+                json.dump(value, file)
+            size = os.path.getsize(tmp_path)
+            # an entry that is overwritten only grows the cache by the difference
+            try:
+                size -= os.path.getsize(self._path(key))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._puts += 1
+            if self._size is None or self._puts % SIZE_RESYNC_PUTS == 0:
+                self._size = self._disk_size()
+            else:
+                self._size += size
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.json'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # evicted by another process meanwhile
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _disk_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache is at 90% of its cap."""
+        entries = sorted(self._entries())
+        size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+
+        evicted = 0
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            evicted += 1
+
+        self._size = size
+        logging.info(f"evicted {evicted} entries from {self.directory}, {size} bytes left")
+
+    def stats(self):
+        """Returns the hit and miss counters and the hit rate."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
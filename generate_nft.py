@@ -1,28 +1,58 @@
 from PIL import Image, ImageDraw, ImageFont
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
+import hashlib
 import json
 import io
+import logging
 import os
 import textwrap
+import threading
 import time
+from urllib.parse import urlparse
+
+from metrics import timed
 
 load_dotenv()
 
 FILEBASE_ACCESS_KEY = os.getenv('FILEBASE_ACCESS_KEY') or ''
 FILEBASE_SECRET_ACCESS_KEY = os.getenv('FILEBASE_SECRET_ACCESS_KEY') or ''
 BASE_IMAGE = 'karaokebackgroundnft.jpg'
-FILEBASE_ENDPOINT = 'https://s3.filebase.com'
-BUCKET_NAME='telegram-karaoke'
+# override to upload to a local S3 stand-in, e.g. moto_server
+FILEBASE_ENDPOINT = os.getenv('FILEBASE_ENDPOINT') or 'https://s3.filebase.com'
+# a local stand-in doesn't pin objects to IPFS, their keys stand in for CIDs
+FILEBASE_LOCAL = urlparse(FILEBASE_ENDPOINT).hostname in ('localhost', '127.0.0.1', '::1')
+BUCKET_NAME = os.getenv('FILEBASE_BUCKET') or 'telegram-karaoke'
+
+# Pooled connections, shared by the NFT jobs running at once
+FILEBASE_MAX_CONNECTIONS = int(os.getenv('FILEBASE_MAX_CONNECTIONS') or 16)
+FILEBASE_MAX_ATTEMPTS = int(os.getenv('FILEBASE_MAX_ATTEMPTS') or 5)
+FILEBASE_CONNECT_TIMEOUT = float(os.getenv('FILEBASE_CONNECT_TIMEOUT') or 5)
+FILEBASE_READ_TIMEOUT = float(os.getenv('FILEBASE_READ_TIMEOUT') or 30)
 
 s3 = boto3.client('s3',
 	endpoint_url=FILEBASE_ENDPOINT,
 	aws_access_key_id=FILEBASE_ACCESS_KEY,
-	aws_secret_access_key=FILEBASE_SECRET_ACCESS_KEY)
-
-font = ImageFont.truetype('FreeMono.ttf', 200)
+	aws_secret_access_key=FILEBASE_SECRET_ACCESS_KEY,
+	config=Config(
+		max_pool_connections=FILEBASE_MAX_CONNECTIONS,
+		retries={'max_attempts': FILEBASE_MAX_ATTEMPTS, 'mode': 'standard'},
+		connect_timeout=FILEBASE_CONNECT_TIMEOUT,
+		read_timeout=FILEBASE_READ_TIMEOUT,
+	))
+
+NFT_FONT = os.getenv('NFT_FONT') or 'FreeMono.ttf'
+# JPEG quality of the rendered NFT, and the longest side of the image in
+# pixels, 0 keeps the size of the base image
+NFT_JPEG_QUALITY = int(os.getenv('NFT_JPEG_QUALITY') or 75)
+NFT_IMAGE_SIZE = int(os.getenv('NFT_IMAGE_SIZE') or 0)
+
+FONT_SIZE = 200
+STROKE_WIDTH = 7
 TEXT_COLOR=(255, 153, 18)
 
 
@@ -35,55 +65,161 @@ IMG_MAP = {
 }
 
 
-def generate_nft_image(score, song_title, save_to_disk=False):
-    base_image = IMG_MAP.get(song_title, BASE_IMAGE)
-    img = Image.open(base_image)
-
-    draw = ImageDraw.Draw(img)
-
-    # text wrap the image so title can overflow
-    offset = 212
-    for line in textwrap.wrap(song_title, width=13):
-        draw.text((212, offset), line, font=font, fill=TEXT_COLOR, stroke_width=7)
+class NftRenderer:
+    """
+    Renders NFT images from base images decoded once, with each song's title
+    already drawn in.
 
-        left, top, right, bottom = font.getbbox(line)
-        width = right - left
-        height = bottom - top
+    The first render of a song decodes its base image, draws the wrapped title
+    and scales the result to size, and keeps that layer. Every render after
+    that only draws the score onto a copy of the layer and encodes it.
+    """
 
-        offset += height + 100
+    def __init__(self, img_map=IMG_MAP, default_image=BASE_IMAGE, font_path=NFT_FONT, quality=NFT_JPEG_QUALITY,
+                 size=NFT_IMAGE_SIZE):
+        self.img_map = img_map
+        self.default_image = default_image
+        self.font_path = font_path
+        self.quality = quality
+        self.size = size
+        self._bases = {}
+        self._layers = {}
+        self._fonts = {}
+        self._lock = threading.Lock()
+
+    def _font(self, size):
+        if size not in self._fonts:
+            self._fonts[size] = ImageFont.truetype(self.font_path, size)
+        return self._fonts[size]
+
+    def _base(self, song_title):
+        path = self.img_map.get(song_title, self.default_image)
+        if not os.path.exists(path):
+            logging.warning(f"no nft image {path} for {song_title}, using {self.default_image}")
+            path = self.default_image
+        if path not in self._bases:
+            with Image.open(path) as img:
+                self._bases[path] = img.convert('RGB')
+        return self._bases[path]
+
+    def _layer(self, song_title):
+        """Returns the song's base image with its title drawn in, and its scale from the base image."""
+        with self._lock:
+            if song_title in self._layers:
+                return self._layers[song_title]
+
+            img = self._base(song_title).copy()
+            draw = ImageDraw.Draw(img)
+            font = self._font(FONT_SIZE)
+
+            # text wrap the image so title can overflow
+            offset = 212
+            for line in textwrap.wrap(song_title, width=13):
+                draw.text((212, offset), line, font=font, fill=TEXT_COLOR, stroke_width=STROKE_WIDTH)
+
+                left, top, right, bottom = font.getbbox(line)
+                offset += bottom - top + 100
+
+            scale = 1
+            if self.size and self.size < max(img.size):
+                scale = self.size / max(img.size)
+                img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+                # the score font is needed at the scaled size from now on
+                self._font(round(FONT_SIZE * scale))
+
+            self._layers[song_title] = (img, scale)
+            return self._layers[song_title]
+
+    def preload(self, song_titles=None):
+        """Prepares the layers of song_titles, every song in the image map by default."""
+        for song_title in song_titles or self.img_map:
+            self._layer(song_title)
+
+    def render_image(self, score, song_title):
+        """Returns the NFT of a score as a PIL image."""
+        layer, scale = self._layer(song_title)
+        img = layer.copy()
+        ImageDraw.Draw(img).text(
+            (round(212 * scale), round(1812 * scale)),
+            f"Score: {score}",
+            font=self._fonts[round(FONT_SIZE * scale)],
+            fill=TEXT_COLOR,
+            stroke_width=round(STROKE_WIDTH * scale),
+        )
+        return img
+
+    def render(self, score, song_title):
+        """Returns the NFT of a score as JPEG bytes."""
+        with timed('render'):
+            out = io.BytesIO()
+            self.render_image(score, song_title).save(out, format='JPEG', quality=self.quality)
+            return out.getvalue()
+
+
+_RENDERER = NftRenderer()
+
+
+def preload_nft_assets():
+    """Decodes the base images and draws every song's title ahead of the first mint."""
+    _RENDERER.preload()
 
 
-    draw.text(
-        (212, 1812),
-        f"Score: {score}",
-        font=font,
-        fill=TEXT_COLOR,
-        stroke_width=7,
-    )
+def generate_nft_image(score, song_title, save_to_disk=False):
+    data = _RENDERER.render(score, song_title)
 
     if save_to_disk:
         timestamp = time.strftime("%Y%m%d%H%M%S")
         filename = f'images/nft_{timestamp}.jpg'
-        img.save(filename)
+        with open(filename, 'wb') as file:
+            file.write(data)
+
+    return io.BytesIO(data)
+
+class MissingCidError(Exception):
+    """Filebase returned no IPFS CID for an uploaded object."""
+
+
+def _cid(key, headers):
+    # Filebase pins every object to IPFS and returns its CID, a local S3
+    # stand-in (e.g. moto in development) doesn't, the key stands in for it
+    cid = headers.get('x-amz-meta-cid')
+    if cid:
+        return cid
+    if FILEBASE_LOCAL:
+        return key
+    # never mint a key as if it were a CID, the nft job retries instead
+    raise MissingCidError(f"no CID for {key} from {FILEBASE_ENDPOINT}")
 
-    in_mem_file = io.BytesIO()
-    img.save(in_mem_file, format=img.format)
-    in_mem_file.seek(0)
 
-    return in_mem_file
+def upload_content(data, prefix, extension, content_type):
+    """
+    Uploads data under a key derived from its sha256, returns its CID.
+
+    Bytes that were uploaded before aren't sent again, the existing object's
+    CID is returned instead.
+    """
+    key = f'{prefix}/{hashlib.sha256(data).hexdigest()}.{extension}'
+
+    with timed('upload'):
+        try:
+            response = s3.head_object(Bucket=BUCKET_NAME, Key=key)
+            return _cid(key, response['ResponseMetadata']['HTTPHeaders'])
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+
+        response = s3.put_object(Body=data, Bucket=BUCKET_NAME, Key=key, ContentType=content_type)
+        return _cid(key, response['ResponseMetadata']['HTTPHeaders'])
+
 
 def create_upload_nft(score, song_id):
     """
     Returns the json metadata CID after uploading image and metadata to Filebase.
     """
-    data = generate_nft_image(score, song_id)
+    data = _RENDERER.render(score, song_id)
     timestamp = time.strftime("%Y%m%d%H%M%S")
-    filename = f'images/nft_{timestamp}.jpg'
 
-    response = s3.put_object(Body=data, Bucket=BUCKET_NAME, Key=filename)
-
-    headers = response['ResponseMetadata']['HTTPHeaders']
-    image_cid = headers['x-amz-meta-cid']
+    image_cid = upload_content(data, 'images', 'jpg', 'image/jpeg')
     image_url = f'ipfs://{image_cid}'
 
     nft_json = {
@@ -107,16 +243,8 @@ def create_upload_nft(score, song_id):
         ]
     }
 
-    nft_json_filename = f'json/nft_{timestamp}.json'
-
-
     nft_json_str = json.dumps(nft_json)
-    response = s3.put_object(Body=nft_json_str.encode('utf-8'), Bucket=BUCKET_NAME, Key=nft_json_filename)
-
-
-
-    headers = response['ResponseMetadata']['HTTPHeaders']
-    json_cid = headers['x-amz-meta-cid']
+    json_cid = upload_content(nft_json_str.encode('utf-8'), 'json', 'json', 'application/json')
 
     return json_cid
 
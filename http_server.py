@@ -0,0 +1,110 @@
+"""
+Minimal asyncio HTTP/1.1 server for the bot's own endpoints on HTTP_PORT:
+Prometheus metrics and, in webhook mode, the updates Telegram posts.
+
+One request per connection, bodies up to MAX_BODY_BYTES.
+"""
+
+import asyncio
+import http
+import logging
+import os
+from collections import namedtuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 0 disables the server, in polling mode only
+HTTP_PORT = int(os.getenv('HTTP_PORT') or 8000)
+MAX_BODY_BYTES = 1 << 20
+READ_TIMEOUT_SECONDS = 10
+
+Request = namedtuple('Request', ['method', 'path', 'headers', 'body'])
+
+
+class HttpServer:
+    """
+    Routes requests by method and path to async handlers.
+
+    A handler takes a Request, with lower case header names, and returns
+    (status, body bytes, content type).
+    """
+
+    def __init__(self, port=HTTP_PORT):
+        self.port = port
+        self._routes = {}
+        self._server = None
+
+    def route(self, method, path, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        if self._server is None and self.port:
+            self._server = await asyncio.start_server(self._handle, port=self.port)
+            logging.info(f"serving {', '.join(path for _, path in self._routes)} on port {self.port}")
+
+    async def stop(self):
+        """Stops accepting connections, requests already being handled are answered."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) < 2:
+            return None
+
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise ValueError(f'body of {length} bytes is too large')
+        body = await reader.readexactly(length) if length else b''
+
+        return Request(request_line[0], request_line[1].split('?')[0], headers, body)
+
+    async def _respond(self, request):
+        if request is None:
+            return http.HTTPStatus.BAD_REQUEST, b'bad request\n', 'text/plain'
+
+        handler = self._routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return http.HTTPStatus.METHOD_NOT_ALLOWED, b'method not allowed\n', 'text/plain'
+            return http.HTTPStatus.NOT_FOUND, b'not found\n', 'text/plain'
+
+        try:
+            return await handler(request)
+        except Exception:
+            logging.exception(f"handling {request.method} {request.path} failed")
+            return http.HTTPStatus.INTERNAL_SERVER_ERROR, b'internal server error\n', 'text/plain'
+
+    async def _handle(self, reader, writer):
+        try:
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), timeout=READ_TIMEOUT_SECONDS)
+            except ValueError:
+                status, body, content_type = http.HTTPStatus.REQUEST_ENTITY_TOO_LARGE, b'too large\n', 'text/plain'
+            else:
+                status, body, content_type = await self._respond(request)
+
+            status = http.HTTPStatus(status)
+            writer.write(
+                f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,152 @@
+"""
+Leaderboard with bounded top-K tables, rank lookups and on-disk persistence.
+
+Every game is appended to a JSON lines file and replayed on startup. In
+memory, the global leaderboard and each song's leaderboard keep a min-heap of
+their K best games and a Fenwick tree of score counts, so recording a game
+and finding a player's rank are O(log n), and rendering is O(K).
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LEADERBOARD_FILE = os.getenv('LEADERBOARD_FILE') or 'data/leaderboard.jsonl'
+LEADERBOARD_TOP_K = int(os.getenv('LEADERBOARD_TOP_K') or 10)
+
+# compare_audios scores are ints between 0 and 100,000
+MAX_SCORE = 100000
+
+
+class _ScoreCounts:
+    """Fenwick tree of how many games scored each value."""
+
+    def __init__(self, max_score=MAX_SCORE):
+        self._tree = [0] * (max_score + 2)
+
+    def add(self, score):
+        i = score + 1
+        while i < len(self._tree):
+            self._tree[i] += 1
+            i += i & -i
+
+    def count_at_most(self, score):
+        i = min(score + 1, len(self._tree) - 1)
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+class _Board:
+    """The top K games and score counts of one leaderboard."""
+
+    def __init__(self, top_k):
+        self.top_k = top_k
+        self.games = 0
+        self.counts = _ScoreCounts()
+        self.best = {}
+        self._heap = []
+
+    def add(self, seq, entry):
+        score = entry['score']
+        self.games += 1
+        self.counts.add(score)
+
+        user_id = entry.get('user_id')
+        if user_id is not None and score > self.best.get(user_id, -1):
+            self.best[user_id] = score
+
+        # ties keep the earlier game
+        item = (score, -seq, entry)
+        if len(self._heap) < self.top_k:
+            heapq.heappush(self._heap, item)
+        elif item[:2] > self._heap[0][:2]:
+            heapq.heapreplace(self._heap, item)
+
+    def top(self):
+        return [entry for _, _, entry in sorted(self._heap, key=lambda item: item[:2], reverse=True)]
+
+    def rank(self, score):
+        """1 + the number of games that scored strictly higher."""
+        return self.games - self.counts.count_at_most(score) + 1
+
+
+class Leaderboard:
+    """
+    Global and per song_id leaderboards.
+
+    Entries are dicts with score, song_id, username and user_id.
+    """
+
+    def __init__(self, path=LEADERBOARD_FILE, top_k=LEADERBOARD_TOP_K):
+        self.path = path
+        self.top_k = top_k
+        self._seq = itertools.count()
+        self._global = _Board(top_k)
+        self._songs = {}
+
+    def _record(self, entry):
+        seq = next(self._seq)
+        entry = dict(entry, score=min(max(int(entry['score']), 0), MAX_SCORE))
+        self._global.add(seq, entry)
+        self._songs.setdefault(entry['song_id'], _Board(self.top_k)).add(seq, entry)
+
+    def load(self):
+        """Replays the games saved on disk."""
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, 'r') as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._record(json.loads(line))
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    logging.warning(f"skipping bad leaderboard line: {line}")
+
+        logging.info(f"loaded {self._global.games} games from {self.path}")
+
+    def add(self, entry):
+        """Records a game and appends it to the leaderboard file."""
+        self._record(entry)
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(entry) + '\n')
+
+    def _board(self, song_id):
+        if song_id is None:
+            return self._global
+        return self._songs.get(song_id)
+
+    def top(self, song_id=None):
+        """Returns the top K entries, best first, globally or for one song."""
+        board = self._board(song_id)
+        return board.top() if board else []
+
+    def rank(self, user_id, song_id=None):
+        """
+        Returns (rank, best score) of a user's best game, globally or for one
+        song, or None if they haven't played it.
+        """
+        board = self._board(song_id)
+        if board is None or user_id not in board.best:
+            return None
+
+        score = board.best[user_id]
+        return board.rank(score), score
+
+    def games(self, song_id=None):
+        """Returns the number of games played, globally or for one song."""
+        board = self._board(song_id)
+        return board.games if board else 0
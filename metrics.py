@@ -0,0 +1,175 @@
+"""
+Per-stage latency histograms, counters and gauges, served in Prometheus text
+format on /metrics (see http_server.py).
+
+Stages time themselves with `with timed('pitch'):`. Scoring workers are
+other processes, so what they record is drained after every job, posted to
+the scoring queue and merged into the bot's registry (see scoring_worker.py
+and ScoringExecutor). Gauges such as queue depths are read when scraped.
+"""
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+# seconds, from a cache hit to transcribing a long reference track
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """Counts of observations per bucket upper bound, plus their sum."""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, counts, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.sum += total
+
+    def quantile(self, q):
+        """Estimates a quantile by interpolating within its bucket, like Prometheus' histogram_quantile."""
+        count = self.count
+        if count == 0:
+            return None
+
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+def _labels(labels):
+    return ','.join(f'{name}="{value}"' for name, value in labels)
+
+
+class Registry:
+    """Stage histograms and counters of this process, and the gauges read on scrape."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            self._stages.setdefault(stage, Histogram()).observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, help_text, fn):
+        """Registers fn() as the value of gauge name, replacing any earlier one."""
+        self._gauges[name] = (help_text, fn)
+
+    def drain(self):
+        """Returns everything observed since the last drain and forgets it, for merge() in another process."""
+        with self._lock:
+            stages = {stage: (histogram.counts, histogram.sum) for stage, histogram in self._stages.items()}
+            counters = self._counters
+            self._stages, self._counters = {}, {}
+        return stages, counters
+
+    def merge(self, drained):
+        stages, counters = drained
+        with self._lock:
+            for stage, (counts, total) in stages.items():
+                self._stages.setdefault(stage, Histogram()).merge(counts, total)
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def stages(self):
+        with self._lock:
+            return {stage: histogram for stage, histogram in sorted(self._stages.items())}
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauges(self):
+        values = {}
+        for name, (_, fn) in sorted(self._gauges.items()):
+            try:
+                values[name] = fn()
+            except Exception:
+                logging.exception(f"reading gauge {name} failed")
+        return values
+
+    def render(self):
+        """Returns every metric in Prometheus text format."""
+        lines = [
+            '# HELP karaoke_stage_seconds Time spent in each stage of scoring and minting.',
+            '# TYPE karaoke_stage_seconds histogram',
+        ]
+        for stage, histogram in self.stages().items():
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, '+Inf'), histogram.counts):
+                cumulative += count
+                lines.append(f'karaoke_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'karaoke_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'karaoke_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE {name} counter')
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f'{name}{{{_labels(labels)}}} {value}')
+
+        values = self.gauges()
+        for name, value in values.items():
+            lines.append(f'# HELP {name} {self._gauges[name][0]}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """Records the time spent in the with block under stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(stage, time.perf_counter() - start)
+
+
+def inc(name, value=1, **labels):
+    REGISTRY.inc(name, value, **labels)
+
+
+def cache_hit_rate(cache):
+    """Returns the hit rate of a FeatureCache by its metrics name, or None before its first lookup."""
+    hits = REGISTRY.counter('karaoke_cache_requests_total', cache=cache, result='hit')
+    misses = REGISTRY.counter('karaoke_cache_requests_total', cache=cache, result='miss')
+    return hits / (hits + misses) if hits + misses else None
+
+
+async def metrics_endpoint(request):
+    """HttpServer handler of GET /metrics."""
+    return 200, REGISTRY.render().encode(), 'text/plain; version=0.0.4; charset=utf-8'
@@ -0,0 +1,211 @@
+"""
+Inference server owning the ASR model, so the scoring workers of a host share
+one copy of it instead of each loading their own:
+
+    python model_server.py
+
+It loads the ASR_BACKEND model, then listens on the MODEL_SERVER_SOCKET Unix
+socket. Processes with MODEL_SERVER_SOCKET set send it decoded PCM instead of
+loading the model (see process_audio.get_transcriber), and clips from all of
+them are batched together. The bot starts one for its local scoring workers.
+
+Each request is a JSON header {'method', 'clips'} followed by that many
+float32 PCM frames, each answer a JSON {'result'} or {'error'}.
+"""
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from dotenv import load_dotenv
+
+from asr_backends import create_backend
+from transcription_service import TranscriptionService
+
+load_dotenv()
+
+# set in processes that transcribe through a model server
+MODEL_SERVER_SOCKET = os.getenv('MODEL_SERVER_SOCKET') or ''
+DEFAULT_MODEL_SERVER_SOCKET = 'data/model_server.sock'
+# how long clients wait for the server to come up and load its model
+MODEL_SERVER_CONNECT_TIMEOUT_SECONDS = float(os.getenv('MODEL_SERVER_CONNECT_TIMEOUT_SECONDS') or 600)
+
+
+class ModelServerError(Exception):
+    """The model server failed a request."""
+
+
+class ModelServerUnavailable(ModelServerError):
+    """The model server couldn't be reached, e.g. while it is restarted."""
+
+
+class ModelServer:
+    """Serves one ASR backend to every client, a thread per connection."""
+
+    def __init__(self, path=MODEL_SERVER_SOCKET or DEFAULT_MODEL_SERVER_SOCKET, backend=None):
+        self.path = path
+        self.backend = backend or create_backend()
+        self.transcription = TranscriptionService(self._transcribe_batch)
+        self._model_lock = threading.Lock()
+        self._listener = None
+        self._stopping = threading.Event()
+
+    def stop(self, *args):
+        self._stopping.set()
+        if self._listener is not None:
+            # wakes up accept
+            try:
+                Client(self.path, family='AF_UNIX').close()
+            except OSError:
+                pass
+
+    def _transcribe_batch(self, audios):
+        with self._model_lock:
+            return self.backend.transcribe_batch(audios)
+
+    def _transcribe_words(self, audio):
+        with self._model_lock:
+            return [[word, float(start), float(end)] for word, start, end in self.backend.transcribe_words(audio)]
+
+    def _handle(self, method, audios):
+        if method == 'params':
+            return self.backend.params()
+        if method == 'transcribe_batch':
+            futures = [self.transcription.submit(audio) for audio in audios]
+            return [future.result() for future in futures]
+        if method == 'transcribe_words':
+            return self._transcribe_words(audios[0])
+        raise ModelServerError(f"unknown method {method}")
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    header = json.loads(connection.recv_bytes())
+                    # copied, torch wants writable arrays
+                    audios = [np.frombuffer(connection.recv_bytes(), dtype=np.float32).copy() for _ in range(header['clips'])]
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    response = {'result': self._handle(header['method'], audios)}
+                except Exception as e:
+                    logging.exception(f"model server {header['method']} failed")
+                    response = {'error': f'{type(e).__name__}: {e}'}
+
+                try:
+                    connection.send_bytes(json.dumps(response).encode())
+                except OSError:
+                    return
+
+    def serve_forever(self):
+        self.backend.load()
+
+        # a socket left behind by a server that died
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._listener = Listener(self.path, family='AF_UNIX')
+        os.chmod(self.path, 0o600)
+        logging.info(f"model server listening on {self.path}")
+
+        try:
+            while not self._stopping.is_set():
+                connection = self._listener.accept()
+                if self._stopping.is_set():
+                    connection.close()
+                    break
+                threading.Thread(target=self._serve, args=(connection,), name='model-client', daemon=True).start()
+        finally:
+            # closing the listener removes the socket
+            self._listener.close()
+            self.transcription.shutdown()
+            logging.info("model server stopped")
+
+
+class ModelServerClient:
+    """
+    An asr_backends backend that runs on a model server. Each thread gets its
+    own connection.
+    """
+
+    def __init__(self, path=MODEL_SERVER_SOCKET, connect_timeout=MODEL_SERVER_CONNECT_TIMEOUT_SECONDS):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            deadline = time.monotonic() + self.connect_timeout
+            while True:
+                try:
+                    connection = Client(self.path, family='AF_UNIX')
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() > deadline:
+                        raise ModelServerUnavailable(f"no model server on {self.path} after {self.connect_timeout}s") from None
+                    time.sleep(0.5)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method, audios):
+        connection = self._connect()
+        try:
+            connection.send_bytes(json.dumps({'method': method, 'clips': len(audios)}).encode())
+            for audio in audios:
+                connection.send_bytes(np.ascontiguousarray(audio, dtype=np.float32))
+            return json.loads(connection.recv_bytes())
+        except (EOFError, OSError) as e:
+            connection.close()
+            self._local.connection = None
+            raise ModelServerUnavailable(f"lost the model server on {self.path}: {e}") from e
+
+    def _call(self, method, audios=()):
+        try:
+            response = self._request(method, audios)
+        except ModelServerUnavailable as e:
+            # requests are safe to repeat, once more on a new connection,
+            # waiting for the server if it is being restarted
+            logging.warning(f"{e}, reconnecting")
+            response = self._request(method, audios)
+
+        if 'error' in response:
+            raise ModelServerError(f"model server {method} failed: {response['error']}")
+        return response['result']
+
+    def load(self):
+        """Waits until the server is up with its model loaded."""
+        self._connect()
+        logging.info(f"using the model server on {self.path}")
+
+    def params(self):
+        return self._call('params')
+
+    def transcribe(self, audio):
+        [text] = self._call('transcribe_batch', [audio])
+        return text
+
+    def transcribe_batch(self, audios):
+        return self._call('transcribe_batch', audios)
+
+    def transcribe_words(self, audio):
+        return [tuple(word) for word in self._call('transcribe_words', [audio])]
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    server = ModelServer()
+    signal.signal(signal.SIGTERM, server.stop)
+    signal.signal(signal.SIGINT, server.stop)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
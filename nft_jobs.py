@@ -0,0 +1,288 @@
+"""
+Durable background queue for rendering, uploading and minting NFTs.
+
+Jobs live in a SQLite table so they survive restarts. Each job goes
+pending -> uploaded -> minting -> done, saving the metadata CID after the
+upload and the transaction hash as soon as it is sent, so a retry never
+uploads twice and only mints again once the previous transaction is known to
+be gone. Failed jobs are retried with exponential backoff until they run out
+of attempts. Jobs are keyed by an idempotency key, enqueuing the same game
+twice is a no-op. Several jobs run at once, so their mints can share one
+batch transaction.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+
+from dotenv import load_dotenv
+
+from contract_interaction import MINT_BATCH_MAX, get_contract_client, get_mint_batcher
+from generate_nft import create_upload_nft, preload_nft_assets
+from metrics import inc, timed
+
+load_dotenv()
+
+NFT_JOBS_DB = os.getenv('NFT_JOBS_DB') or 'data/nft_jobs.sqlite3'
+NFT_JOB_MAX_ATTEMPTS = int(os.getenv('NFT_JOB_MAX_ATTEMPTS') or 5)
+NFT_JOB_RETRY_SECONDS = float(os.getenv('NFT_JOB_RETRY_SECONDS') or 10)
+# also the most mints that can wait for a batch together, fewer than
+# MINT_BATCH_MAX keep batches from ever filling up
+NFT_JOB_CONCURRENCY = int(os.getenv('NFT_JOB_CONCURRENCY') or MINT_BATCH_MAX)
+# how long stop() lets running jobs finish before cancelling them
+NFT_JOB_SHUTDOWN_SECONDS = float(os.getenv('NFT_JOB_SHUTDOWN_SECONDS') or 30)
+
+PENDING = 'pending'
+UPLOADED = 'uploaded'
+MINTING = 'minting'
+DONE = 'done'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS nft_jobs (
+    idempotency_key TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    song_id TEXT NOT NULL,
+    to_addr TEXT NOT NULL,
+    status TEXT NOT NULL,
+    json_cid TEXT,
+    txn_hash TEXT,
+    token_id INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class NftJobQueue:
+    """
+    Runs up to concurrency NFT jobs at a time in the background of the bot's event loop.
+
+    on_complete: coroutine called with the job dict once it is done or has
+    failed for good, e.g. to message the player.
+    """
+
+    def __init__(self, on_complete, path=NFT_JOBS_DB, max_attempts=NFT_JOB_MAX_ATTEMPTS,
+                 retry_seconds=NFT_JOB_RETRY_SECONDS, concurrency=NFT_JOB_CONCURRENCY):
+        self.on_complete = on_complete
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.concurrency = concurrency
+        self._db = None
+        self._task = None
+        self._running = {}
+        self._wake = asyncio.Event()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, isolation_level=None)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(_SCHEMA)
+            # databases from before token ids were recorded
+            columns = [row['name'] for row in self._db.execute('PRAGMA table_info(nft_jobs)')]
+            if 'token_id' not in columns:
+                self._db.execute('ALTER TABLE nft_jobs ADD COLUMN token_id INTEGER')
+        return self._db
+
+    def _update(self, key, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{column} = ?' for column in fields)
+        self._connect().execute(
+            f'UPDATE nft_jobs SET {columns} WHERE idempotency_key = ?', (*fields.values(), key),
+        )
+
+    def enqueue(self, idempotency_key, chat_id, score, song_id, to_addr):
+        """Adds a job, returns False if a job with this key already exists."""
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT OR IGNORE INTO nft_jobs '
+            '(idempotency_key, chat_id, score, song_id, to_addr, status, next_attempt_at, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (idempotency_key, chat_id, score, song_id, to_addr, PENDING, now, now, now),
+        )
+        self._wake.set()
+        return cursor.rowcount == 1
+
+    def get(self, idempotency_key):
+        row = self._connect().execute(
+            'SELECT * FROM nft_jobs WHERE idempotency_key = ?', (idempotency_key,),
+        ).fetchone()
+        return dict(row) if row else None
+
+    def pending_count(self):
+        """Returns the number of jobs not done or failed yet."""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM nft_jobs WHERE status IN (?, ?, ?)', (PENDING, UPLOADED, MINTING),
+        ).fetchone()[0]
+
+    def start(self):
+        """Starts working through the queue, including jobs left over from a previous run."""
+        db = self._connect()
+
+        # Jobs interrupted while minting resume from their transaction hash,
+        # which is saved as soon as the transaction is sent. Without one no
+        # transaction went out, the job mints again.
+        for row in db.execute('SELECT idempotency_key FROM nft_jobs WHERE status = ?', (MINTING,)).fetchall():
+            self._update(row['idempotency_key'], status=UPLOADED)
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=NFT_JOB_SHUTDOWN_SECONDS):
+        """
+        Stops starting jobs and gives the running ones up to timeout seconds
+        to finish, then cancels them. Cancelled jobs resume on the next start.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        running = list(self._running.values())
+        if running:
+            _, unfinished = await asyncio.wait(running, timeout=timeout)
+            if unfinished:
+                logging.warning(f"{len(unfinished)} nft jobs still running after {timeout}s, cancelling them")
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _next_job(self):
+        """
+        Returns the next due job that isn't running yet, and the seconds until
+        the one after it is due.
+        """
+        db = self._connect()
+        running = list(self._running)
+        not_running = f"idempotency_key NOT IN ({', '.join('?' * len(running))})"
+        row = db.execute(
+            f'SELECT * FROM nft_jobs WHERE status IN (?, ?) AND next_attempt_at <= ? AND {not_running} '
+            'ORDER BY next_attempt_at LIMIT 1',
+            (PENDING, UPLOADED, time.time(), *running),
+        ).fetchone()
+        if row:
+            return dict(row), 0
+
+        row = db.execute(
+            f'SELECT MIN(next_attempt_at) FROM nft_jobs WHERE status IN (?, ?) AND {not_running}',
+            (PENDING, UPLOADED, *running),
+        ).fetchone()
+        wait = row[0] - time.time() if row[0] is not None else None
+        return None, wait
+
+    def _job_finished(self, key):
+        self._running.pop(key, None)
+        self._wake.set()
+
+    async def _run(self):
+        try:
+            await asyncio.to_thread(preload_nft_assets)
+        except Exception:
+            logging.exception("preloading nft assets failed, they will load on first use")
+
+        while True:
+            job, wait = None, None
+            if len(self._running) < self.concurrency:
+                job, wait = self._next_job()
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key = job['idempotency_key']
+            task = asyncio.create_task(self._process(job))
+            self._running[key] = task
+            task.add_done_callback(lambda _, key=key: self._job_finished(key))
+
+    async def _previous_mint(self, job):
+        """
+        Returns (receipt, token_id) of a job's earlier transaction, or None if
+        it was dropped and the job should mint again.
+        """
+        client = get_contract_client()
+        receipt = await client.get_receipt(job['txn_hash'])
+        if receipt is None:
+            if await client.is_known(job['txn_hash']):
+                raise RuntimeError(f"transaction {job['txn_hash']} is still pending")
+            return None
+
+        # a batch mints to several players, only a recipient that appears once tells which token is ours
+        token_ids = []
+        if receipt['status'] == 1:
+            token_ids = [
+                token_id for to_addr, token_id in client.minted_tokens(receipt)
+                if to_addr.lower() == job['to_addr'].lower()
+            ]
+        return receipt, token_ids[0] if len(token_ids) == 1 else None
+
+    async def _process(self, job):
+        key = job['idempotency_key']
+        try:
+            if job['status'] == PENDING:
+                logging.info(f"nft job {key}: generating nft image and metadata")
+                json_cid = await asyncio.to_thread(create_upload_nft, job['score'], job['song_id'])
+                self._update(key, status=UPLOADED, json_cid=json_cid)
+                job.update(status=UPLOADED, json_cid=json_cid)
+
+            minted = None
+            if job['txn_hash']:
+                minted = await self._previous_mint(job)
+
+            if minted is None:
+                logging.info(f"nft job {key}: minting nft for {job['json_cid']}")
+                self._update(key, status=MINTING)
+                with timed('mint'):
+                    minted = await get_mint_batcher().mint(
+                        job['to_addr'],
+                        f"ipfs://{job['json_cid']}",
+                        on_sent=lambda txn_hash: self._update(key, txn_hash=txn_hash),
+                    )
+
+            receipt, token_id = minted
+            if receipt['status'] != 1:
+                raise RuntimeError('mint transaction reverted')
+
+            txn_hash = receipt['transactionHash'].to_0x_hex()
+            self._update(key, status=DONE, txn_hash=txn_hash, token_id=token_id)
+            job.update(status=DONE, txn_hash=txn_hash, token_id=token_id)
+            logging.info(f"nft job {key}: minted token {token_id}, tx {txn_hash}")
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            # retries resume after the upload, and check the sent transaction first
+            status = UPLOADED if job.get('json_cid') else PENDING
+            if attempts >= self.max_attempts:
+                status = FAILED
+            logging.exception(f"nft job {key} failed (attempt {attempts})")
+            inc('karaoke_nft_job_failures_total', final=str(status == FAILED).lower())
+            self._update(
+                key,
+                status=status,
+                attempts=attempts,
+                last_error=str(e),
+                next_attempt_at=time.time() + self.retry_seconds * 2 ** (attempts - 1),
+            )
+            job.update(status=status, attempts=attempts, last_error=str(e), txn_hash=self.get(key)['txn_hash'])
+            if status != FAILED:
+                return
+
+        try:
+            await self.on_complete(job)
+        except Exception:
+            logging.exception(f"nft job {key}: completion callback failed")
@@ -0,0 +1,229 @@
+"""
+Joins Ogg/Opus streams packet by packet, without decoding or re-encoding.
+
+Telegram voice messages are all Ogg/Opus with the same codec configuration,
+so a whole performance can be built by copying the audio packets of every
+line into one logical stream behind the first line's headers.
+"""
+
+import struct
+import zlib
+
+
+class OggOpusError(ValueError):
+    """The input is not a single Ogg/Opus stream, or the streams can't be joined."""
+
+
+# Ogg uses a non-reflected CRC-32 (poly 0x04c11db7, no init or final xor).
+# zlib's crc32 is the reflected form of the same polynomial, so it gives the
+# Ogg CRC on bit-reversed input, bit-reversed back.
+_REVERSE_BITS = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
+
+def _ogg_crc(data):
+    crc = zlib.crc32(data.translate(_REVERSE_BITS), 0xffffffff) ^ 0xffffffff
+    return int(f'{crc:032b}'[::-1], 2)
+
+
+def _read_stream(data):
+    """
+    Returns (serial, packets, final granule position) of an Ogg stream.
+    """
+    serial = None
+    packets = []
+    partial = []
+    granule = -1
+
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 4] != b'OggS' or len(data) < pos + 27:
+            raise OggOpusError(f"no Ogg page at byte {pos}")
+
+        page_granule, page_serial = struct.unpack_from('<qI', data, pos + 6)
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            raise OggOpusError("multiplexed or chained Ogg streams are not supported")
+
+        segments = data[pos + 26]
+        lacing = data[pos + 27:pos + 27 + segments]
+        body_pos = pos + 27 + segments
+
+        for lace in lacing:
+            partial.append(data[body_pos:body_pos + lace])
+            body_pos += lace
+            if lace < 255:
+                packets.append(b''.join(partial))
+                partial = []
+
+        if page_granule != -1:
+            granule = page_granule
+        pos = body_pos
+
+    if pos != len(data) or partial:
+        raise OggOpusError("truncated Ogg stream")
+
+    return serial, packets, granule
+
+
+def ogg_opus_duration(data):
+    """
+    Returns the length of an Ogg/Opus stream in seconds, read from its page
+    headers without assembling or decoding any packet.
+
+    Raises OggOpusError if data isn't a single Ogg/Opus stream.
+    """
+    if len(data) < 27 or data[:4] != b'OggS' or data[27 + data[26]:][:8] != b'OpusHead':
+        raise OggOpusError("not an Ogg/Opus stream")
+    head = data[27 + data[26]:]
+    if len(head) < 12:
+        raise OggOpusError("truncated OpusHead")
+    pre_skip = struct.unpack_from('<H', head, 10)[0]
+
+    granule = -1
+    pos = 0
+    while pos < len(data):
+        if data[pos:pos + 4] != b'OggS' or len(data) < pos + 27:
+            raise OggOpusError(f"no Ogg page at byte {pos}")
+        page_granule = struct.unpack_from('<q', data, pos + 6)[0]
+        if page_granule != -1:
+            granule = page_granule
+        segments = data[pos + 26]
+        pos += 27 + segments + sum(data[pos + 27:pos + 27 + segments])
+
+    # granule positions count 48 kHz samples, including the encoder's pre-skip
+    return max(granule - pre_skip, 0) / 48000
+
+
+def _packet_samples(packet):
+    """Returns the duration of an Opus packet in 48 kHz samples, from its TOC byte."""
+    if not packet:
+        return 0
+
+    config = packet[0] >> 3
+    if config < 12:
+        frame_size = (480, 960, 1920, 2880)[config % 4]
+    elif config < 16:
+        frame_size = (480, 960)[config % 2]
+    else:
+        frame_size = (120, 240, 480, 960)[config % 4]
+
+    code = packet[0] & 0x3
+    if code == 0:
+        frames = 1
+    elif code < 3:
+        frames = 2
+    else:
+        frames = packet[1] & 0x3f if len(packet) > 1 else 0
+
+    return frame_size * frames
+
+
+def _codec_config(head):
+    """The parts of an OpusHead packet that must match for streams to be joined."""
+    # channels, pre-skip, output gain and channel mapping, but not the informational input rate
+    return head[9:12] + head[16:]
+
+
+class _OggWriter:
+    """Paginates packets into a single logical Ogg stream."""
+
+    MAX_PAGE_BODY = 4096
+
+    def __init__(self, serial):
+        self.serial = serial
+        self.pages = []
+        self._seq = 0
+        self._lacing = []
+        self._body = []
+        self._body_size = 0
+        self._granule = -1
+        self._continued = False
+
+    def add_packet(self, packet, granule):
+        if self._body_size >= self.MAX_PAGE_BODY:
+            self.flush()
+
+        lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+        pos = 0
+        for i, lace in enumerate(lacing):
+            if len(self._lacing) == 255:
+                self.flush()
+                self._continued = i > 0
+            self._lacing.append(lace)
+            self._body.append(packet[pos:pos + lace])
+            self._body_size += lace
+            pos += lace
+
+        self._granule = granule
+
+    def flush(self, eos=False):
+        if not self._lacing and not eos:
+            return
+
+        header_type = (0x01 if self._continued else 0) | (0x02 if self._seq == 0 else 0) | (0x04 if eos else 0)
+        page = bytearray(struct.pack(
+            '<4sBBqIIIB', b'OggS', 0, header_type, self._granule, self.serial, self._seq, 0, len(self._lacing),
+        ))
+        page += bytes(self._lacing)
+        page += b''.join(self._body)
+        struct.pack_into('<I', page, 22, _ogg_crc(bytes(page)))
+        self.pages.append(bytes(page))
+
+        self._seq += 1
+        self._lacing = []
+        self._body = []
+        self._body_size = 0
+        self._granule = -1
+        self._continued = False
+
+    def close(self, final_granule):
+        self._granule = final_granule
+        self.flush(eos=True)
+        return b''.join(self.pages)
+
+
+def concatenate_ogg_opus(streams):
+    """
+    Joins Ogg/Opus streams into one, returns its bytes.
+
+    The first stream's headers are kept and every stream's audio packets are
+    copied after them with rewritten granule positions. Only the first
+    stream's pre-skip is applied, so later lines keep their few milliseconds
+    of encoder priming. Raises OggOpusError if a stream isn't Ogg/Opus or its
+    codec configuration differs from the first one.
+    """
+    if not streams:
+        raise OggOpusError("nothing to concatenate")
+
+    writer = None
+    head = None
+    position = 0
+    end_trim = 0
+
+    for data in streams:
+        serial, packets, final_granule = _read_stream(data)
+        if len(packets) < 2 or not packets[0].startswith(b'OpusHead') or not packets[1].startswith(b'OpusTags'):
+            raise OggOpusError("not an Ogg/Opus stream")
+
+        if writer is None:
+            head = packets[0]
+            writer = _OggWriter(serial)
+            writer.add_packet(packets[0], 0)
+            writer.flush()
+            writer.add_packet(packets[1], 0)
+            writer.flush()
+        elif _codec_config(packets[0]) != _codec_config(head):
+            raise OggOpusError("streams have different Opus configurations")
+
+        stream_samples = 0
+        for packet in packets[2:]:
+            samples = _packet_samples(packet)
+            stream_samples += samples
+            position += samples
+            writer.add_packet(packet, position)
+
+        # only the end trimming of the last stream is kept
+        end_trim = max(stream_samples - final_granule, 0) if final_granule >= 0 else 0
+
+    return writer.close(position - end_trim)
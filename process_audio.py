@@ -1,8 +1,4 @@
 import numpy as np # numpy==1.25
-from pydub import AudioSegment
-from pydub.playback import play
-from pydub.generators import Sine
-import whisper
 from whisper_normalizer.basic import BasicTextNormalizer
 import librosa
 import json
@@ -12,138 +8,619 @@ import os
 import logging
 import warnings
 import csv
+import difflib
+import hashlib
+import subprocess
+import threading
+from dotenv import load_dotenv
 from jiwer import wer
 
+from asr_backends import create_backend
+from feature_cache import FeatureCache
+from metrics import inc, timed
+from model_server import MODEL_SERVER_SOCKET, ModelServerClient, ModelServerError
+from ogg_opus import concatenate_ogg_opus, ogg_opus_duration, OggOpusError
+
+
+load_dotenv()
+
+# Audio is decoded once at Whisper's rate (whisper.audio.SAMPLE_RATE) and
+# shared with the pitch/tempo analysis
+SAMPLE_RATE = 16000
+# librosa's default framing for both piptrack and the onset envelope
+N_FFT = 2048
+HOP_LENGTH = 512
+# reference line slices are at least this long
+MIN_LINE_SECONDS = 0.5
+
+# Silence is trimmed before transcription and pitch/tempo analysis. Frames
+# more than VAD_TOP_DB quieter than the loudest one are silent, silent gaps
+# longer than VAD_MAX_GAP_SECONDS are cut, keeping VAD_PADDING_SECONDS of
+# audio around every voiced span.
+VAD_ENABLED = (os.getenv('VAD_ENABLED') or 'true').lower() in ('1', 'true', 'yes')
+VAD_TOP_DB = float(os.getenv('VAD_TOP_DB') or 40)
+VAD_MAX_GAP_SECONDS = float(os.getenv('VAD_MAX_GAP_SECONDS') or 0.4)
+VAD_PADDING_SECONDS = float(os.getenv('VAD_PADDING_SECONDS') or 0.1)
+
+# A performance, or a line, less than half as long as its reference scores 0
+LENGTH_DIFFERENCE_THRESHOLD = 0.5
+# Lines with less than SILENCE_MIN_SECONDS of frames whose RMS is louder than
+# SILENCE_DBFS are rejected as silent before any transcription or pitch/tempo
+# analysis. A click or pop alone is far shorter.
+SILENCE_DBFS = float(os.getenv('SILENCE_DBFS') or -50)
+SILENCE_MIN_SECONDS = float(os.getenv('SILENCE_MIN_SECONDS') or 0.25)
 
-transcriber = whisper.load_model('medium.en')
 normalizer = BasicTextNormalizer()
 
+# The ASR_BACKEND model is loaded on first use. With MODEL_SERVER_SOCKET set, a
+# model_server.py process runs it instead and this one never loads it.
+_asr_backend = create_backend()
+_transcriber = None
+_transcriber_lock = threading.Lock()
+
+# Everything the extracted features depend on. Bump FEATURE_ALGORITHM whenever
+# the extraction code changes in a way these parameters don't capture, so
+# features computed by an older algorithm are never reused.
+FEATURE_ALGORITHM = 1
+FEATURE_PARAMS = {
+    'algorithm': FEATURE_ALGORITHM,
+    'asr': _asr_backend.params(),
+    'normalizer': 'BasicTextNormalizer',
+    'sample_rate': SAMPLE_RATE,
+    'n_fft': N_FFT,
+    'hop_length': HOP_LENGTH,
+    'librosa': librosa.__version__,
+    'vad': [VAD_TOP_DB, VAD_MAX_GAP_SECONDS, VAD_PADDING_SECONDS] if VAD_ENABLED else None,
+}
+
+
+# Transcripts and features are cached by audio content and feature version,
+# each directory capped in size.
+TRANSCRIPT_CACHE = FeatureCache(
+    os.getenv('TRANSCRIPT_CACHE_DIR') or "data/lyrics/",
+    int(os.getenv('TRANSCRIPT_CACHE_MAX_MB') or 64) * 1024 * 1024,
+)
+FEATURE_CACHE = FeatureCache(
+    os.getenv('FEATURE_CACHE_DIR') or "data/audio_features",
+    int(os.getenv('FEATURE_CACHE_MAX_MB') or 256) * 1024 * 1024,
+)
+
+
+def get_transcriber():
+    """Returns the ASR backend, loading its model, or connecting to the model server, on first use."""
+    global _transcriber
+
+    if _transcriber is None:
+        with _transcriber_lock:
+            if _transcriber is None:
+                if MODEL_SERVER_SOCKET:
+                    transcriber = ModelServerClient()
+                    transcriber.load()
+                    # transcripts are cached under this process's settings
+                    if transcriber.params() != _asr_backend.params():
+                        raise ModelServerError(
+                            f"the model server runs {transcriber.params()}, "
+                            f"this process is configured for {_asr_backend.params()}"
+                        )
+                else:
+                    transcriber = _asr_backend
+                    transcriber.load()
+                _transcriber = transcriber
+
+    return _transcriber
+
+
+def feature_version():
+    """Returns a short hash identifying FEATURE_PARAMS."""
+    params = json.dumps(FEATURE_PARAMS, sort_keys=True)
+    return hashlib.sha256(params.encode('utf-8')).hexdigest()[:16]
+
+
+def decode_audio(data, sr=SAMPLE_RATE):
+    """
+    Decodes audio bytes in any container ffmpeg understands to mono float32 PCM.
 
-def concatenate_audio(recordings):
+    data: the encoded audio, e.g. an ogg voice message or an mp3.
+    """
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "f32le", "-ac", "1", "-acodec", "pcm_f32le", "-ar", str(sr),
+        "pipe:1",
+    ]
+    try:
+        with timed('decode'):
+            out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode audio: {e.stderr.decode()}") from e
+
+    return np.frombuffer(out, np.float32)
+
+def encode_audio(pcm, sr=SAMPLE_RATE):
+    """
+    Encodes mono float32 PCM to ogg/opus bytes.
     """
-    Concatenates audio together.
+    cmd = [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        "-f", "f32le", "-ac", "1", "-ar", str(sr), "-i", "pipe:0",
+        "-c:a", "libopus", "-f", "ogg",
+        "pipe:1",
+    ]
+    try:
+        return subprocess.run(cmd, input=pcm.astype(np.float32).tobytes(), capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to encode audio: {e.stderr.decode()}") from e
+
+def probe_duration(data):
+    """
+    Returns the length of encoded audio in seconds, from the Ogg/Opus page
+    headers of voice messages, or by decoding anything else.
+    """
+    try:
+        return ogg_opus_duration(data)
+    except OggOpusError:
+        return len(decode_audio(data)) / SAMPLE_RATE
+
+def is_silent(y, sr=SAMPLE_RATE):
+    """Whether decoded audio has less than SILENCE_MIN_SECONDS of frames louder than SILENCE_DBFS."""
+    if not len(y):
+        return True
+    rms = librosa.feature.rms(y=y, frame_length=N_FFT, hop_length=HOP_LENGTH)[0]
+    loud_frames = int(np.count_nonzero(rms > 10 ** (SILENCE_DBFS / 20)))
+    return loud_frames * HOP_LENGTH / sr < SILENCE_MIN_SECONDS
+
+def trim_silence(y, sr=SAMPLE_RATE):
+    """
+    Drops the silence before, after and between the phrases of decoded audio.
 
-    recordings: a list of recording file names, in ogg format.
+    Returns (trimmed audio, seconds removed). Audio that is silent throughout
+    is returned as is.
     """
-    sound = AudioSegment.from_file(recordings[0], format="ogg")
-    filename = recordings[0].removesuffix('.ogg')
+    if not VAD_ENABLED or len(y) == 0:
+        return y, 0.0
 
+    with timed('vad'):
+        intervals = librosa.effects.split(y, top_db=VAD_TOP_DB, frame_length=N_FFT, hop_length=HOP_LENGTH)
+        if len(intervals) == 0:
+            return y, 0.0
 
-    for recording in recordings[1:]:
-        sound += AudioSegment.from_file(recording, format="ogg")
+        padding = int(VAD_PADDING_SECONDS * sr)
+        max_gap = int(VAD_MAX_GAP_SECONDS * sr)
+        spans = []
+        for start, end in intervals:
+            start, end = max(start - padding, 0), min(end + padding, len(y))
+            if spans and start - spans[-1][1] <= max_gap:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
 
-    combined_filename = f'{filename}_combined.ogg'
+        trimmed = np.concatenate([y[start:end] for start, end in spans])
 
-    return sound.export(combined_filename, format='ogg'), combined_filename
+    removed = (len(y) - len(trimmed)) / sr
+    inc('karaoke_vad_input_seconds_total', len(y) / sr)
+    inc('karaoke_vad_removed_seconds_total', removed)
 
+    return trimmed, removed
 
+def concatenate_audio(recordings):
+    """
+    Concatenates audio together, returns the ogg bytes of the whole performance.
+
+    Ogg/Opus recordings sharing a codec configuration are joined packet by
+    packet, anything else is decoded, joined once and encoded.
+
+    recordings: a list of recordings, as ogg bytes.
+    """
+    with timed('concat'):
+        try:
+            return concatenate_ogg_opus(recordings)
+        except OggOpusError as e:
+            logging.info(f"Can't join recordings without decoding: {e}")
 
-def _transcribe(input_file, output_dir="data/lyrics/"):
-    os.makedirs(output_dir, exist_ok=True)
-    file_name = input_file.split('/')[-1].split('.')[0].split('_')[0]
-    output_file = os.path.join(output_dir, file_name + ".txt")
+        return encode_audio(np.concatenate([decode_audio(recording) for recording in recordings]))
 
 
-    if os.path.exists(output_file):
-        with open(output_file, "r") as file:
-            return file.read()
+
+def _transcribe(audio, key, use_cache=True):
+    """
+    Transcribes decoded audio, cached under the key of its encoded bytes.
+    """
+    if use_cache:
+        cached = TRANSCRIPT_CACHE.get(key)
+        if cached is not None:
+            return cached["text"]
 
 
-    logging.info(f"Input file:{input_file}")
+    logging.info(f"Transcribing {len(audio) / SAMPLE_RATE:.1f}s of audio")
 
-    cwd = os.getcwd()
-    logging.info(f"cwd: {cwd}")
-    logging.info(f"Input file exists: {os.path.exists(input_file)}")
-    result = transcriber.transcribe(input_file)["text"]
+    transcriber = get_transcriber()
+    with timed('transcribe'):
+        result = transcriber.transcribe(audio)
 
     result = normalizer(result)
 
-    with open(output_file, "w") as file:
-        file.write(result)
-        logging.info(f"Saved transcription for {input_file}.")
+    TRANSCRIPT_CACHE.put(key, {"text": result})
+    logging.info(f"Saved transcription for {key}.")
 
     return result
 
-def _extract_features(audio_file, output_dir="data/audio_features"):
-    file_name = os.path.basename(audio_file).split('.')[0]
-    feature_file = os.path.join(output_dir, file_name + "_features.json")
+def transcribe_batch(audios):
+    """
+    Transcribes several decoded clips at once, returns their normalized texts.
 
-    if os.path.exists(feature_file):
-        logging.info(f"Loading cached features for {audio_file}")
-        with open(feature_file, "r") as file:
-            return json.load(file)
+    Backends that can decode clips together do, see asr_backends.
+    """
+    transcriber = get_transcriber()
+    with timed('transcribe'):
+        texts = transcriber.transcribe_batch(audios)
 
-    logging.info('transcribing')
-    text = _transcribe(audio_file)
-    logging.info('transcribing done')
+    return [normalizer(text) for text in texts]
 
-    logging.info('librosa pitch and beat analysis')
-    y, sr = librosa.load(audio_file)
-    logging.info('librosa pitch and beat analysis, load audio done')
-    pitches, magnitudes = librosa.piptrack(y=y, sr=sr)
-    logging.info('librosa pitch and beat analysis piptrack')
-    pitch_track = [np.max(pitches[i]) for i in range(pitches.shape[0]) if np.max(pitches[i]) > 0]
-    logging.info('librosa pitch and beat analysis pitch_track')
-    average_pitch = np.mean(pitch_track) if pitch_track else 0
-    logging.info('librosa pitch and beat analysis average_pitch')
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr)
-    logging.info('librosa pitch and beat analysis tempo')
-    duration = librosa.get_duration(y=y, sr=sr)
-    logging.info('librosa pitch and beat analysis duration')
+def acoustic_features(y, sr=SAMPLE_RATE):
+    """
+    Returns the pitch, tempo and duration features of decoded audio.
+
+    One STFT is shared by the pitch tracking and the onset envelope the tempo
+    is estimated from, with the same framing librosa.piptrack and
+    librosa.beat.beat_track would each use on their own.
+    """
+    with timed('stft'):
+        S = np.abs(librosa.stft(y, n_fft=N_FFT, hop_length=HOP_LENGTH))
+
+    # highest pitch found in each frequency bin across all frames
+    with timed('pitch'):
+        pitches, _ = librosa.piptrack(S=S, sr=sr, hop_length=HOP_LENGTH)
+        pitch_bins = pitches.max(axis=1)
+        pitch_track = pitch_bins[pitch_bins > 0]
+
+    with timed('tempo'):
+        mel = librosa.power_to_db(librosa.feature.melspectrogram(S=S ** 2, sr=sr))
+        onset_envelope = librosa.onset.onset_strength(S=mel, sr=sr, hop_length=HOP_LENGTH, aggregate=np.median)
+        tempo, _ = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, hop_length=HOP_LENGTH)
 
     if isinstance(tempo, np.ndarray):
         tempo = float(tempo[0])
 
-    norm = float(np.linalg.norm(np.array(pitch_track)))
+    return {
+        "bpm": float(tempo),
+        "duration": len(y) / sr,
+        "average_pitch": float(np.mean(pitch_track)) if len(pitch_track) else 0.0,
+        "pitch_track": float(np.linalg.norm(pitch_track)),
+        "pitch_range": len(pitch_track),
+        "pitch_bins": pitch_bins.astype(float).tolist(),
+    }
 
+def _extract_features(data, use_cache=True):
+    """
+    Extracts the features of encoded audio bytes.
+
+    The audio is decoded once, the same samples go to Whisper and librosa.
+    """
+    key = FEATURE_CACHE.key(data, feature_version())
+
+    if use_cache:
+        cached = FEATURE_CACHE.get(key)
+        if cached is not None:
+            logging.info(f"Loading cached features for {key}")
+            return cached
+
+    y, sr = decode_audio(data), SAMPLE_RATE
+    y, trimmed = trim_silence(y)
+    logging.info(f'decode audio done, {trimmed:.1f}s of silence trimmed')
+
+    logging.info('transcribing')
+    text = _transcribe(y, key, use_cache=use_cache)
+    logging.info('transcribing done')
+
+    logging.info('librosa pitch and beat analysis')
+    output = acoustic_features(y, sr)
+    output["text"] = text
+    output["trimmed_seconds"] = trimmed
     logging.info('librosa pitch and beat analysis DONE')
 
-    output = {
-        "bpm": tempo,
+    FEATURE_CACHE.put(key, output)
+
+    return output
+
+def rejected_line(duration, reason):
+    """The features of a line rejected before analysis, scored as not sung at all."""
+    inc('karaoke_lines_rejected_total', reason=reason)
+    return {
+        "bpm": 0.0,
         "duration": duration,
-        "average_pitch": float(average_pitch),
-        "pitch_track": norm,
-        "text": text,
-        "pitch_range": len(pitch_track)
+        "average_pitch": 0.0,
+        "pitch_track": 0.0,
+        "pitch_range": 0,
+        "pitch_bins": [0.0] * (N_FFT // 2 + 1),
+        "text": "",
+        "rejected": reason,
     }
 
-    output = {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in output.items()}
+def _too_short(duration, reference_seconds):
+    return reference_seconds is not None and duration < reference_seconds * LENGTH_DIFFERENCE_THRESHOLD
 
-    os.makedirs(output_dir, exist_ok=True)
-    with open(feature_file, "w") as file:
-        json.dump(output, file, indent=4)
+def prepare_line(recording, reference_seconds=None):
+    """
+    Analyzes a sung line up to its transcription, so transcription can be batched.
 
-    return output
+    Lines under half as long as reference_seconds, their part of the reference
+    track, or silent are rejected without transcription or pitch/tempo analysis
+    (see rejected_line). The length is read from the container before decoding,
+    and checked again once silence is trimmed.
+
+    Returns (key, features, audio). audio is the decoded line if it still has to
+    be transcribed and passed to complete_line, or None if the features are complete.
+    """
+    key = FEATURE_CACHE.key(recording, feature_version())
+
+    cached = FEATURE_CACHE.get(key)
+    if cached is not None:
+        return key, cached, None
+
+    with timed('probe'):
+        duration = probe_duration(recording)
+    if _too_short(duration, reference_seconds):
+        return key, rejected_line(duration, 'too_short'), None
+
+    y = decode_audio(recording)
+    if is_silent(y):
+        return key, rejected_line(len(y) / SAMPLE_RATE, 'silent'), None
+
+    y, trimmed = trim_silence(y)
+    if _too_short(len(y) / SAMPLE_RATE, reference_seconds):
+        return key, rejected_line(len(y) / SAMPLE_RATE, 'too_short'), None
+
+    features = acoustic_features(y)
+    features["trimmed_seconds"] = trimmed
+
+    transcript = TRANSCRIPT_CACHE.get(key)
+    if transcript is not None:
+        return key, complete_line(key, features, transcript["text"]), None
+
+    return key, features, y
+
+def complete_line(key, features, text):
+    """Adds the transcription to prepared line features and caches them."""
+    features["text"] = text
+    TRANSCRIPT_CACHE.put(key, {"text": text})
+    FEATURE_CACHE.put(key, features)
+
+    return features
+
+def aggregate_line_features(line_features):
+    """
+    Combines per-line features into the features of the whole performance.
+
+    The per-bin pitch maxima of the whole performance are the maxima over its
+    lines, tempo is the duration weighted average of the lines' tempos.
+    """
+    duration = sum(features["duration"] for features in line_features)
+
+    pitch_bins = np.max([features["pitch_bins"] for features in line_features], axis=0)
+    pitch_track = pitch_bins[pitch_bins > 0]
+
+    bpm = 0.0
+    if duration > 0:
+        bpm = sum(features["bpm"] * features["duration"] for features in line_features) / duration
+
+    return {
+        "bpm": float(bpm),
+        "duration": duration,
+        "average_pitch": float(np.mean(pitch_track)) if len(pitch_track) else 0.0,
+        "pitch_track": float(np.linalg.norm(pitch_track)),
+        "text": " ".join(features["text"] for features in line_features if features["text"]),
+        "lyrics": " ".join(features["lyrics"] for features in line_features if features["lyrics"]),
+        "pitch_range": len(pitch_track),
+        "pitch_bins": pitch_bins.tolist(),
+    }
+
+def extract_reference_features(reference_file):
+    """
+    Extracts the features of a reference track.
+
+    Cached results are only reused for identical audio and feature version.
+    """
+    with open(reference_file, "rb") as file:
+        return _extract_features(file.read())
+
+def transcribe_words(audio):
+    """
+    Transcribes decoded audio with word timestamps.
+
+    Returns [(word, start seconds, end seconds)], words normalized like lyrics.
+    """
+    transcriber = get_transcriber()
+    with timed('transcribe'):
+        result = transcriber.transcribe_words(audio)
+
+    words = []
+    for word, start, end in result:
+        for token in normalizer(word).split():
+            words.append((token, start, end))
+    return words
+
+def align_lyrics(words, lines, duration):
+    """
+    Returns the (start, end) seconds of each lyric line within a track.
+
+    Lyrics are matched to the track's transcribed words in order, a line spans
+    its matched words. Runs of lines none of whose words were recognized share
+    the time between their neighbours in proportion to their word counts.
+
+    words: the track's words, see transcribe_words.
+    lines: the lyrics, line by line.
+    duration: the track's length in seconds.
+    """
+    line_tokens = [normalizer(line).split() for line in lines]
+    lyric_tokens = [token for tokens in line_tokens for token in tokens]
+    token_lines = [i for i, tokens in enumerate(line_tokens) for _ in tokens]
+
+    matched = [[] for _ in lines]
+    matcher = difflib.SequenceMatcher(None, lyric_tokens, [word for word, _, _ in words], autojunk=False)
+    for lyric_index, word_index, size in matcher.get_matching_blocks():
+        for k in range(size):
+            _, start, end = words[word_index + k]
+            matched[token_lines[lyric_index + k]].append((start, end))
+
+    spans = [(min(start for start, _ in times), max(end for _, end in times)) if times else None for times in matched]
+
+    i = 0
+    while i < len(spans):
+        if spans[i] is not None:
+            i += 1
+            continue
+
+        j = i
+        while j < len(spans) and spans[j] is None:
+            j += 1
+        gap_start = spans[i - 1][1] if i else 0.0
+        gap_end = spans[j][0] if j < len(spans) else duration
+
+        weights = [max(len(line_tokens[k]), 1) for k in range(i, j)]
+        start = gap_start
+        for k, weight in zip(range(i, j), weights):
+            end = start + (gap_end - gap_start) * weight / sum(weights)
+            spans[k] = (start, end)
+            start = end
+        i = j
+
+    return spans
+
+def extract_reference_lines(reference_file, lines):
+    """
+    Aligns a reference track to its lyrics and extracts the features of each line's slice.
+
+    Returns [{"start", "end", "seconds", "features"}], one per lyric line.
+    Slices are trimmed of silence like sung lines are, seconds is the length
+    left, which sung lines are measured against.
+    """
+    with open(reference_file, "rb") as file:
+        y = decode_audio(file.read())
+    duration = len(y) / SAMPLE_RATE
+
+    spans = align_lyrics(transcribe_words(y), lines, duration)
+
+    reference_lines = []
+    for start, end in spans:
+        # too short a slice has no pitch or tempo to compare
+        end = min(max(end, start + MIN_LINE_SECONDS), duration)
+        start = max(min(start, end - MIN_LINE_SECONDS), 0.0)
+        reference_lines.append({"start": start, "end": end})
+
+    def analyze_slice(line):
+        audio, _ = trim_silence(y[int(line["start"] * SAMPLE_RATE):int(line["end"] * SAMPLE_RATE)])
+        return acoustic_features(audio)
+
+    # the slices are independent, and the FFTs release the GIL
+    with ThreadPoolExecutor() as pool:
+        for line, features in zip(reference_lines, pool.map(analyze_slice, reference_lines)):
+            line["features"] = features
+            line["seconds"] = features["duration"]
+
+    return reference_lines
+
+def _line_similarity(reference_features, features):
+    if features.get("rejected"):
+        return 0.0
+
+    word_error_rate = _word_error_rate(features["lyrics"], features["text"])
+
+    return max(_similarity(reference_features, features, word_error_rate), 0)
+
+def score_lines(reference, line_features, reference_lines=None):
+    """
+    Scores a performance from the features of its already analyzed lines.
+
+    With the reference track's aligned lines (see extract_reference_lines),
+    each sung line is compared to its own slice of the reference and the line
+    scores are averaged, weighted by the slices' lengths. The performance's
+    length is checked against the sung part of the reference. Rejected lines
+    (see prepare_line) score 0.
+
+    Otherwise lyrics are checked against each line's expected lyrics, pitch
+    and tempo against the reference track's features (see reference_index.py).
+    """
+    performance = aggregate_line_features(line_features)
+
+    if reference_lines and len(reference_lines) == len(line_features):
+        sung_duration = sum(line["seconds"] for line in reference_lines)
+        if not _lengths_match(sung_duration, performance["duration"]):
+            return 0.0
+
+        score = sum(
+            _line_similarity(line["features"], features) * line["seconds"]
+            for line, features in zip(reference_lines, line_features)
+        ) / sung_duration
+        return int(score * 100000)
+
+    if all(features.get("rejected") for features in line_features):
+        return 0.0
+
+    word_error_rate = _word_error_rate(performance["lyrics"], performance["text"])
+
+    return score_features(reference, performance, word_error_rate)
 
 def compare_audios(file1, file2):
     """Compare two audio files based on their pitch, tempo, length, and text similarity."""
 
-    feature1 = _extract_features(file1)
-    feature2 = _extract_features(file2)
+    with open(file1, "rb") as file:
+        data1 = file.read()
+    with open(file2, "rb") as file:
+        data2 = file.read()
 
-    pk, pq = feature1["pitch_range"], feature2["pitch_range"]
+    # mismatched lengths score 0, found out before transcribing anything
+    with timed('probe'):
+        if not _lengths_match(probe_duration(data1), probe_duration(data2)):
+            return 0.0
+
+    feature1 = _extract_features(data1)
+    feature2 = _extract_features(data2)
 
-    length_difference_threshold = 0.5
-    if feature1["duration"] * length_difference_threshold - feature2["duration"] > 0 or feature2["duration"] * length_difference_threshold - feature1["duration"] > 0  :
+    word_error_rate = _word_error_rate(feature1["text"], feature2["text"])
+
+    return score_features(feature1, feature2, word_error_rate)
+
+def _word_error_rate(lyrics, text):
+    """
+    WER of a transcript against the expected words. A transcript with no
+    words missed all of them, only lyrics that are unknown give no WER.
+    """
+    if not lyrics:
+        return 0.0
+    if not text:
+        return 1.0
+    with timed('wer'):
+        return wer(lyrics, text)
+
+def _lengths_match(duration1, duration2):
+    """Whether neither duration is less than half the other."""
+    return not (duration1 * LENGTH_DIFFERENCE_THRESHOLD - duration2 > 0 or duration2 * LENGTH_DIFFERENCE_THRESHOLD - duration1 > 0)
+
+def score_features(feature1, feature2, word_error_rate):
+    """Scores the pitch, tempo and length of two feature sets along with their word error rate."""
+
+    if not _lengths_match(feature1["duration"], feature2["duration"]):
         return 0.0
 
+    return int(max(_similarity(feature1, feature2, word_error_rate), 0) * 100000)
+
+def _similarity(feature1, feature2, word_error_rate):
+    """Scores the pitch and tempo of two feature sets along with their word error rate, 1 for a perfect match."""
+
+    pk, pq = feature1["pitch_range"], feature2["pitch_range"]
+
     pitch_diff = np.abs(feature1["pitch_track"] - feature2["pitch_track"])
     tempo_diff = abs(feature1["bpm"] - feature2["bpm"])
 
-    word_error_rate = 0.0
-    if feature1["text"] and feature2["text"]:
-        word_error_rate = wer(feature1["text"], feature2["text"])
-
     pitch_range = max([pk, pq])
     tempo_range = max([feature1["bpm"], feature2["bpm"]])
 
-    normalized_tempo_diff = tempo_diff / tempo_range
-    normalized_pitch_diff = pitch_diff / pitch_range
+    # short or beatless clips can have no tempo or pitch at all
+    normalized_tempo_diff = tempo_diff / tempo_range if tempo_range else 0.0
+    normalized_pitch_diff = pitch_diff / pitch_range if pitch_range else 0.0
 
     logging.info(f"word error rate: {word_error_rate}")
     logging.info(f"pitch diff: {normalized_pitch_diff}")
     logging.info(f"{normalized_tempo_diff}")
 
-    score = (1 - normalized_pitch_diff - normalized_tempo_diff)*0.15 + (1 - word_error_rate)*0.85
-
-    return int(max(score, 0) * 100000)
+    return (1 - normalized_pitch_diff - normalized_tempo_diff)*0.15 + (1 - word_error_rate)*0.85
@@ -0,0 +1,143 @@
+"""
+Versioned index of the reference tracks' features.
+
+Build it offline with `python reference_index.py`. Scoring workers load it
+at startup so no game ever pays for analyzing a reference track. Besides the
+whole track's features, each song's lyric lines are aligned to time ranges of
+its reference track with the features of every slice, so sung lines are
+compared to their own part of the song. The index records the feature and
+alignment versions it was built with, a hash of each reference file and of
+its lyrics, and is refused when any no longer matches.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+from process_audio import extract_reference_features, extract_reference_lines, feature_version, FEATURE_PARAMS
+from songs import SONG_REFERENCES, SONGS
+
+load_dotenv()
+
+REFERENCE_INDEX_FILE = os.getenv('REFERENCE_INDEX_FILE') or 'data/reference_index.json'
+# bump when align_lyrics or the slicing in extract_reference_lines changes
+ALIGNMENT_VERSION = 2
+
+
+class StaleReferenceIndexError(Exception):
+    """The reference index is missing, or was built from other parameters or tracks."""
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _song_lines(song_id):
+    return [line['lyrics'] for line in SONGS[song_id]]
+
+
+def _lyrics_sha256(lines):
+    return hashlib.sha256('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def _entry(song):
+    return {'features': song['features'], 'lines': song['lines']}
+
+
+def build_reference_index(song_references=SONG_REFERENCES, index_file=REFERENCE_INDEX_FILE):
+    """
+    Extracts the features of every reference track and of its aligned lines, and writes the index.
+
+    Returns {song_id: {'features', 'lines'}}, see process_audio.extract_reference_lines.
+    """
+    songs = {}
+    for song_id, reference_file in song_references.items():
+        logging.info(f"extracting reference features for {song_id} from {reference_file}")
+        lines = _song_lines(song_id)
+        songs[song_id] = {
+            'reference': reference_file,
+            'sha256': _file_sha256(reference_file),
+            'lyrics_sha256': _lyrics_sha256(lines),
+            'features': extract_reference_features(reference_file),
+            'lines': extract_reference_lines(reference_file, lines),
+        }
+
+    index = {
+        'version': feature_version(),
+        'alignment_version': ALIGNMENT_VERSION,
+        'params': FEATURE_PARAMS,
+        'songs': songs,
+    }
+
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    # scoring workers starting together may each rebuild it
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(index_file) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'w') as file:
+        json.dump(index, file, indent=4)
+    os.replace(tmp_file, index_file)
+
+    logging.info(f"reference index {index['version']} written to {index_file}")
+
+    return {song_id: _entry(song) for song_id, song in songs.items()}
+
+
+def load_reference_index(song_references=SONG_REFERENCES, index_file=REFERENCE_INDEX_FILE):
+    """
+    Returns {song_id: {'features', 'lines'}}.
+
+    Raises StaleReferenceIndexError if the index is missing, was built with a
+    different feature or alignment version, or doesn't match the current
+    reference tracks or lyrics.
+    """
+    if not os.path.exists(index_file):
+        raise StaleReferenceIndexError(f"no reference index at {index_file}")
+
+    with open(index_file, 'r') as file:
+        index = json.load(file)
+
+    if index.get('version') != feature_version():
+        raise StaleReferenceIndexError(
+            f"reference index version {index.get('version')} does not match {feature_version()}"
+        )
+    if index.get('alignment_version') != ALIGNMENT_VERSION:
+        raise StaleReferenceIndexError(
+            f"reference index alignment version {index.get('alignment_version')} does not match {ALIGNMENT_VERSION}"
+        )
+
+    songs = index.get('songs', {})
+    for song_id, reference_file in song_references.items():
+        song = songs.get(song_id)
+        if song is None:
+            raise StaleReferenceIndexError(f"reference index is missing {song_id}")
+        if song['reference'] != reference_file or song['sha256'] != _file_sha256(reference_file):
+            raise StaleReferenceIndexError(f"reference track for {song_id} changed since the index was built")
+        if song.get('lyrics_sha256') != _lyrics_sha256(_song_lines(song_id)):
+            raise StaleReferenceIndexError(f"lyrics of {song_id} changed since the index was built")
+
+    return {song_id: _entry(songs[song_id]) for song_id in song_references}
+
+
+def load_or_build_reference_index(song_references=SONG_REFERENCES, index_file=REFERENCE_INDEX_FILE):
+    """
+    Loads the reference index, rebuilding it first if it is stale.
+    """
+    try:
+        return load_reference_index(song_references, index_file)
+    except StaleReferenceIndexError as e:
+        logging.warning(f"rebuilding reference index: {e}")
+        return build_reference_index(song_references, index_file)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    build_reference_index()
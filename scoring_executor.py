@@ -0,0 +1,259 @@
+"""
+The bot's side of scoring: recordings go to the recording store, jobs to the
+scoring queue, and the results come back from scoring workers (see
+scoring_worker.py) that may run on other nodes, reaching the broker through
+the bot when SCORING_BROKER_LISTEN is set. The bot never loads a model, so
+scoring capacity is added by starting more workers.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from metrics import REGISTRY
+from model_server import DEFAULT_MODEL_SERVER_SOCKET, MODEL_SERVER_SOCKET
+from scoring_jobs import (
+    CONCAT, DONE, LINE, SCORE, SCORING_BROKER_LISTEN, BrokerServer, RecordingStore, ScoringBroker, ScoringJobError,
+    prune_expired,
+)
+
+load_dotenv()
+
+# scoring workers started alongside the bot, 0 if they all run elsewhere
+SCORING_WORKERS = int(os.getenv('SCORING_WORKERS') or 1)
+SCORING_POLL_MS = float(os.getenv('SCORING_POLL_MS') or 20)
+# the local workers share the ASR model of one model_server.py process,
+# instead of each loading it, so their number isn't bound by memory
+SCORING_MODEL_SERVER = (os.getenv('SCORING_MODEL_SERVER') or 'true').lower() in ('1', 'true', 'yes')
+SCORING_RESULT_TIMEOUT_SECONDS = float(os.getenv('SCORING_RESULT_TIMEOUT_SECONDS') or 600)
+# how often workers, their metrics and expired jobs are checked on
+HOUSEKEEPING_SECONDS = 1
+PRUNE_SECONDS = 3600
+# local workers still busy after this long on shutdown are killed
+WORKER_SHUTDOWN_SECONDS = 30
+
+_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scoring_worker.py')
+_MODEL_SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_server.py')
+
+
+class ScoringExecutor:
+    """
+    Submits scoring jobs and awaits their results.
+
+    Results of every job awaited in this process are looked up together by
+    one poller task. ready is set while at least one worker is up with its
+    models loaded.
+    """
+
+    def __init__(self, local_workers=SCORING_WORKERS, broker=None, recordings=None, model_server=SCORING_MODEL_SERVER):
+        self.local_workers = local_workers
+        self.model_server = model_server and local_workers > 0
+        self.model_server_socket = MODEL_SERVER_SOCKET or DEFAULT_MODEL_SERVER_SOCKET
+        self.ready = asyncio.Event()
+        self.broker = broker or ScoringBroker()
+        self.recordings = recordings or RecordingStore()
+        self._waiting = {}
+        self._processes = []
+        self._server_process = None
+        self._broker_server = None
+        self._task = None
+
+    def warm_up(self):
+        """
+        Starts the local workers and the result poller in the background, and
+        serves the broker to remote workers if SCORING_BROKER_LISTEN is set.
+        """
+        if SCORING_BROKER_LISTEN and self._broker_server is None:
+            self._broker_server = BrokerServer(self.broker, self.recordings)
+            self._broker_server.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self._task
+
+    async def _start_model_server(self):
+        env = dict(os.environ, MODEL_SERVER_SOCKET=self.model_server_socket)
+        return await asyncio.create_subprocess_exec(sys.executable, _MODEL_SERVER_SCRIPT, env=env)
+
+    async def _start_worker(self):
+        env = dict(os.environ)
+        if self.model_server:
+            # workers connect once the server has loaded the model
+            env['MODEL_SERVER_SOCKET'] = self.model_server_socket
+        elif not env.get('WHISPER_THREADS'):
+            # the local workers share the cores instead of each running a thread per core
+            env['WHISPER_THREADS'] = str(max((os.cpu_count() or 1) // max(self.local_workers, 1), 1))
+        return await asyncio.create_subprocess_exec(sys.executable, _WORKER_SCRIPT, env=env)
+
+    async def _run(self):
+        if self.model_server:
+            logging.info(f"starting the model server on {self.model_server_socket}")
+            self._server_process = await self._start_model_server()
+        logging.info(f"starting {self.local_workers} local scoring workers")
+        self._processes = [await self._start_worker() for _ in range(self.local_workers)]
+
+        last_housekeeping = last_prune = 0.0
+        while True:
+            await asyncio.sleep(SCORING_POLL_MS / 1000)
+            try:
+                await self._poll()
+
+                now = time.monotonic()
+                if now - last_housekeeping >= HOUSEKEEPING_SECONDS:
+                    last_housekeeping = now
+                    await self._housekeeping()
+                if now - last_prune >= PRUNE_SECONDS:
+                    last_prune = now
+                    await asyncio.to_thread(prune_expired, self.broker, self.recordings)
+            except Exception:
+                logging.exception("polling the scoring queue failed")
+
+    async def _poll(self):
+        if not self._waiting:
+            return
+
+        finished = await asyncio.to_thread(self.broker.finished, list(self._waiting))
+        for job_id, (status, result, error) in finished.items():
+            for future in self._waiting.pop(job_id, []):
+                if future.done():
+                    continue
+                if status == DONE:
+                    future.set_result(result)
+                else:
+                    future.set_exception(ScoringJobError(f"scoring job {job_id} {status}: {error}"))
+
+    async def _housekeeping(self):
+        if self._server_process is not None and self._server_process.returncode is not None:
+            logging.warning(f"model server exited with {self._server_process.returncode}, restarting it")
+            self._server_process = await self._start_model_server()
+
+        for i, process in enumerate(self._processes):
+            if process.returncode is not None:
+                logging.warning(f"scoring worker {process.pid} exited with {process.returncode}, restarting it")
+                self._processes[i] = await self._start_worker()
+
+        for recorded in await asyncio.to_thread(self.broker.take_metrics):
+            REGISTRY.merge(recorded)
+
+        if await asyncio.to_thread(self.broker.ready_workers):
+            if not self.ready.is_set():
+                logging.info("scoring workers ready")
+            self.ready.set()
+        else:
+            self.ready.clear()
+
+    async def _submit(self, kind, payload):
+        return await asyncio.to_thread(self.broker.submit, kind, payload)
+
+    async def wait(self, job_ids):
+        """
+        Returns the results of jobs, in order, once they are all finished.
+
+        Raises ScoringJobError if one failed or was cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for job_id in job_ids:
+            future = loop.create_future()
+            self._waiting.setdefault(job_id, []).append(future)
+            futures.append(future)
+
+        try:
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout=SCORING_RESULT_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise ScoringJobError(f"scoring jobs {job_ids} took over {SCORING_RESULT_TIMEOUT_SECONDS}s") from None
+        finally:
+            for job_id, future in zip(job_ids, futures):
+                waiting = self._waiting.get(job_id, [])
+                if future in waiting:
+                    waiting.remove(future)
+                if not waiting:
+                    self._waiting.pop(job_id, None)
+
+    async def store_recording(self, recording):
+        """Stores ogg bytes where workers can read them, returns their hash."""
+        return await asyncio.to_thread(self.recordings.put, recording)
+
+    async def analyze_line(self, recording, lyrics, song_id, line):
+        """
+        Queues the analysis of one sung line, see process_audio.prepare_line.
+
+        recording: the hash store_recording returned.
+        song_id, line: the song and index of the line, whose length in the
+        reference track lines that are far too short are rejected against.
+        Returns the job id, for score_lines.
+        """
+        return await self._submit(LINE, {'recording': recording, 'lyrics': lyrics, 'song_id': song_id, 'line': line})
+
+    async def score_lines(self, song_id, line_jobs):
+        """
+        Returns the score of a performance once its lines are analyzed.
+
+        line_jobs: the job ids analyze_line returned, in order.
+        """
+        # lines are scored after they are all done, so a score job never waits on other jobs
+        await self.wait(line_jobs)
+        [score] = await self.wait([await self._submit(SCORE, {'song_id': song_id, 'line_jobs': line_jobs})])
+        return score
+
+    async def concatenate_recordings(self, recordings):
+        """
+        Returns the ogg bytes of stored recordings joined together.
+        """
+        [result] = await self.wait([await self._submit(CONCAT, {'recordings': recordings})])
+        return await asyncio.to_thread(self.recordings.get, result['recording'])
+
+    async def cancel(self, job_ids):
+        """Cancels jobs no worker has started yet."""
+        await asyncio.to_thread(self.broker.cancel, job_ids)
+
+    def queued_count(self):
+        return self.broker.queued_count()
+
+    def ready_workers(self):
+        return self.broker.ready_workers()
+
+    async def shutdown(self):
+        """
+        Stops the poller and the local workers, which finish the jobs they
+        claimed, then the model server and the broker server.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        for process in self._processes:
+            if process.returncode is None:
+                process.terminate()
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*[process.wait() for process in self._processes]), timeout=WORKER_SHUTDOWN_SECONDS,
+            )
+        except asyncio.TimeoutError:
+            logging.warning(f"scoring workers still busy after {WORKER_SHUTDOWN_SECONDS}s, killing them")
+            for process in self._processes:
+                if process.returncode is None:
+                    process.kill()
+        self._processes = []
+
+        # after the workers, whose last jobs may still transcribe
+        if self._server_process is not None:
+            if self._server_process.returncode is None:
+                self._server_process.terminate()
+            try:
+                await asyncio.wait_for(self._server_process.wait(), timeout=WORKER_SHUTDOWN_SECONDS)
+            except asyncio.TimeoutError:
+                self._server_process.kill()
+
+        if self._broker_server is not None:
+            await asyncio.to_thread(self._broker_server.stop)
+            self._broker_server = None
+            self._server_process = None
+
+        for futures in self._waiting.values():
+            for future in futures:
+                future.cancel()
+        self._waiting = {}
@@ -0,0 +1,538 @@
+"""
+Work queue between the bot and the scoring workers.
+
+The bot stores recordings in a content-addressed blob directory and enqueues
+jobs that reference them by hash. Any number of scoring_worker.py processes
+claim jobs, post their results back to the job row, and record a heartbeat so
+the bot knows scoring capacity is up.
+
+The broker is a SQLite database next to the blobs, both on the bot's host
+only: SQLite's WAL mode and locking don't work over network filesystems, so
+never put them on NFS or the like. Workers on other hosts go through the
+bot instead, which serves the broker and the blobs on SCORING_BROKER_LISTEN
+(see BrokerServer); they set SCORING_BROKER_ADDRESS to it and get a
+RemoteScoringBroker and RemoteRecordingStore with the same methods from
+connect_broker(). A broker on a database server would plug in there too.
+
+Job kinds:
+    line: {'recording': hash, 'lyrics': str, 'song_id': str, 'line': index} -> the line's features
+    score: {'song_id': str, 'line_jobs': [job ids]} -> the score
+    concat: {'recordings': [hashes]} -> {'recording': hash of the whole performance}
+
+A claimed job is leased to its worker for SCORING_JOB_LEASE_SECONDS, a job
+whose worker died is claimed again once its lease runs out, up to
+SCORING_JOB_MAX_ATTEMPTS times.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SCORING_JOBS_DB = os.getenv('SCORING_JOBS_DB') or 'data/scoring_jobs.sqlite3'
+RECORDINGS_DIR = os.getenv('RECORDINGS_DIR') or 'data/recordings'
+SCORING_JOB_LEASE_SECONDS = float(os.getenv('SCORING_JOB_LEASE_SECONDS') or 300)
+SCORING_JOB_MAX_ATTEMPTS = int(os.getenv('SCORING_JOB_MAX_ATTEMPTS') or 3)
+# finished jobs and recordings are deleted after this long
+SCORING_JOB_TTL_HOURS = float(os.getenv('SCORING_JOB_TTL_HOURS') or 24)
+# a worker that hasn't checked in for this long is considered gone
+WORKER_HEARTBEAT_TIMEOUT_SECONDS = 30
+
+# host:port the bot serves its broker and recordings on for workers on
+# other hosts, empty for none. Keep it on a private network.
+SCORING_BROKER_LISTEN = os.getenv('SCORING_BROKER_LISTEN') or ''
+# host:port of the bot's broker, set on workers that run on other hosts
+SCORING_BROKER_ADDRESS = os.getenv('SCORING_BROKER_ADDRESS') or ''
+# shared secret of the bot and its remote workers
+SCORING_BROKER_AUTHKEY = os.getenv('SCORING_BROKER_AUTHKEY') or ''
+# how long remote workers wait for the bot to come back before giving up
+SCORING_BROKER_CONNECT_TIMEOUT_SECONDS = float(os.getenv('SCORING_BROKER_CONNECT_TIMEOUT_SECONDS') or 120)
+
+LINE = 'line'
+SCORE = 'score'
+CONCAT = 'concat'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# players wait on scores and concatenations, lines are analyzed while they sing
+_PRIORITIES = {LINE: 0, SCORE: 1, CONCAT: 1}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scoring_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scoring_jobs_queue ON scoring_jobs (status, priority, id);
+CREATE TABLE IF NOT EXISTS scoring_workers (
+    worker TEXT PRIMARY KEY,
+    ready INTEGER NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scoring_metrics (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recorded TEXT NOT NULL
+);
+"""
+
+
+class ScoringJobError(Exception):
+    """A scoring job failed in the worker, or was cancelled."""
+
+
+class ScoringBrokerError(Exception):
+    """A remote broker request failed, or the broker couldn't be reached."""
+
+
+class RecordingStore:
+    """Recordings as files named by their sha256."""
+
+    def __init__(self, directory=RECORDINGS_DIR):
+        self.directory = directory
+
+    def _path(self, digest):
+        return os.path.join(self.directory, f'{digest}.ogg')
+
+    def put(self, data):
+        """Stores a recording, returns its hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._path(digest), 'rb') as file:
+            return file.read()
+
+    def prune(self, older_than):
+        """Deletes recordings last written before the older_than timestamp."""
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.scandir(self.directory):
+            if entry.stat().st_mtime < older_than:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class ScoringBroker:
+    """The SQLite job table, shared by the bot and the workers of its host. Each thread gets its own connection."""
+
+    def __init__(self, path=SCORING_JOBS_DB, lease_seconds=SCORING_JOB_LEASE_SECONDS,
+                 max_attempts=SCORING_JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            db.row_factory = sqlite3.Row
+            # local disks only, see the module docstring
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(_SCHEMA)
+            self._local.db = db
+        return db
+
+    def close(self):
+        """Closes this thread's connection."""
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    def submit(self, kind, payload):
+        """Enqueues a job, returns its id."""
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO scoring_jobs (kind, payload, priority, status, created_at, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (kind, json.dumps(payload), _PRIORITIES[kind], QUEUED, now, now),
+        )
+        return cursor.lastrowid
+
+    def cancel(self, job_ids):
+        """Cancels the jobs no worker has claimed yet."""
+        if not job_ids:
+            return
+        self._connect().execute(
+            f"UPDATE scoring_jobs SET status = ?, updated_at = ? "
+            f"WHERE status = ? AND id IN ({', '.join('?' * len(job_ids))})",
+            (CANCELLED, time.time(), QUEUED, *job_ids),
+        )
+
+    def finished(self, job_ids):
+        """Returns {job id: (status, result, error)} of the given jobs that are done, failed or cancelled."""
+        if not job_ids:
+            return {}
+        rows = self._connect().execute(
+            f"SELECT id, status, result, error FROM scoring_jobs "
+            f"WHERE status IN (?, ?, ?) AND id IN ({', '.join('?' * len(job_ids))})",
+            (DONE, FAILED, CANCELLED, *job_ids),
+        ).fetchall()
+        return {
+            row['id']: (row['status'], json.loads(row['result']) if row['result'] else None, row['error'])
+            for row in rows
+        }
+
+    def results(self, job_ids):
+        """Returns the results of done jobs, in order. Raises ScoringJobError if one isn't done."""
+        finished = self.finished(job_ids)
+        results = []
+        for job_id in job_ids:
+            status, result, error = finished.get(job_id, (None, None, None))
+            if status != DONE:
+                raise ScoringJobError(f"job {job_id} is {status or 'not finished'}: {error}")
+            results.append(result)
+        return results
+
+    def claim(self, worker, limit):
+        """
+        Leases up to limit queued jobs to worker, most urgent first, returns
+        them as dicts with their payload decoded.
+        """
+        db = self._connect()
+        now = time.time()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            # jobs of workers that died, retried unless they keep failing
+            db.execute(
+                'UPDATE scoring_jobs SET status = ?, error = ?, updated_at = ? '
+                'WHERE status = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'worker lost', now, RUNNING, now, self.max_attempts),
+            )
+            rows = db.execute(
+                'SELECT * FROM scoring_jobs WHERE status = ? OR (status = ? AND lease_until < ?) '
+                'ORDER BY priority DESC, id LIMIT ?',
+                (QUEUED, RUNNING, now, limit),
+            ).fetchall()
+            if rows:
+                db.execute(
+                    f"UPDATE scoring_jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    f"updated_at = ? WHERE id IN ({', '.join('?' * len(rows))})",
+                    (RUNNING, worker, now + self.lease_seconds, now, *[row['id'] for row in rows]),
+                )
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+        return [dict(row, payload=json.loads(row['payload'])) for row in rows]
+
+    def release(self, job_id, worker):
+        """Puts a job its worker couldn't run for now back in the queue, the attempt isn't counted."""
+        self._connect().execute(
+            'UPDATE scoring_jobs SET status = ?, worker = NULL, lease_until = NULL, attempts = attempts - 1, '
+            'updated_at = ? WHERE id = ? AND worker = ? AND status = ?',
+            (QUEUED, time.time(), job_id, worker, RUNNING),
+        )
+
+    def complete(self, job_id, worker, result):
+        self._finish(job_id, worker, DONE, result=json.dumps(result))
+
+    def fail(self, job_id, worker, error):
+        self._finish(job_id, worker, FAILED, error=error)
+
+    def _finish(self, job_id, worker, status, result=None, error=None):
+        # a worker whose lease ran out doesn't overwrite the job's new owner
+        self._connect().execute(
+            'UPDATE scoring_jobs SET status = ?, result = ?, error = ?, updated_at = ? '
+            'WHERE id = ? AND worker = ? AND status = ?',
+            (status, result, error, time.time(), job_id, worker, RUNNING),
+        )
+
+    def queued_count(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM scoring_jobs WHERE status = ?', (QUEUED,),
+        ).fetchone()[0]
+
+    def heartbeat(self, worker, ready):
+        self._connect().execute(
+            'INSERT INTO scoring_workers (worker, ready, last_seen) VALUES (?, ?, ?) '
+            'ON CONFLICT (worker) DO UPDATE SET ready = excluded.ready, last_seen = excluded.last_seen',
+            (worker, int(ready), time.time()),
+        )
+
+    def remove_worker(self, worker):
+        self._connect().execute('DELETE FROM scoring_workers WHERE worker = ?', (worker,))
+
+    def ready_workers(self):
+        """Returns the number of workers ready to score that checked in recently."""
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM scoring_workers WHERE ready AND last_seen > ?',
+            (time.time() - WORKER_HEARTBEAT_TIMEOUT_SECONDS,),
+        ).fetchone()[0]
+
+    def post_metrics(self, recorded):
+        """Stores what metrics.REGISTRY.drain() returned in a worker, for the bot to merge."""
+        stages, counters = recorded
+        # JSON has no tuples, counters are keyed by (name, ((label, value), ...))
+        encoded = {
+            'stages': stages,
+            'counters': [[name, [list(label) for label in labels], value] for (name, labels), value in counters.items()],
+        }
+        self._connect().execute('INSERT INTO scoring_metrics (recorded) VALUES (?)', (json.dumps(encoded),))
+
+    def take_metrics(self):
+        """Returns and deletes every metrics batch the workers posted, as metrics.REGISTRY.merge() takes them."""
+        db = self._connect()
+        rows = db.execute('SELECT id, recorded FROM scoring_metrics ORDER BY id').fetchall()
+        if rows:
+            db.execute('DELETE FROM scoring_metrics WHERE id <= ?', (rows[-1]['id'],))
+
+        batches = []
+        for row in rows:
+            try:
+                encoded = json.loads(row['recorded'])
+            except (TypeError, ValueError):
+                logging.warning(f"dropping unreadable scoring metrics batch {row['id']}")
+                continue
+            stages = {stage: tuple(histogram) for stage, histogram in encoded['stages'].items()}
+            counters = {
+                (name, tuple(tuple(label) for label in labels)): value for name, labels, value in encoded['counters']
+            }
+            batches.append((stages, counters))
+        return batches
+
+    def prune(self, older_than):
+        """Deletes finished jobs and gone workers last updated before the older_than timestamp."""
+        db = self._connect()
+        db.execute(
+            'DELETE FROM scoring_jobs WHERE status IN (?, ?, ?) AND updated_at < ?',
+            (DONE, FAILED, CANCELLED, older_than),
+        )
+        db.execute('DELETE FROM scoring_workers WHERE last_seen < ?', (older_than,))
+
+
+def prune_expired(broker, recordings, ttl_hours=SCORING_JOB_TTL_HOURS):
+    """Deletes the jobs and recordings older than ttl_hours."""
+    older_than = time.time() - ttl_hours * 3600
+    broker.prune(older_than)
+    recordings.prune(older_than)
+    logging.info(f"pruned scoring jobs and recordings older than {ttl_hours}h")
+
+
+# what scoring workers call, the only methods BrokerServer serves
+_REMOTE_METHODS = {
+    'broker': {'claim', 'release', 'complete', 'fail', 'results', 'heartbeat', 'remove_worker', 'post_metrics'},
+    'recordings': {'get', 'put'},
+}
+
+
+def _address(host_port):
+    host, _, port = host_port.rpartition(':')
+    return host, int(port)
+
+
+class BrokerServer:
+    """
+    Serves a ScoringBroker and RecordingStore to workers on other hosts over
+    TCP, a thread per connection. Connections authenticate with authkey.
+    """
+
+    def __init__(self, broker, recordings, address=SCORING_BROKER_LISTEN, authkey=SCORING_BROKER_AUTHKEY):
+        if not authkey:
+            raise ValueError("SCORING_BROKER_AUTHKEY is required to serve the scoring broker")
+        self.targets = {'broker': broker, 'recordings': recordings}
+        self.address = _address(address)
+        self.authkey = authkey.encode()
+        self._listener = None
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._listener = Listener(self.address, authkey=self.authkey)
+        # the port actually bound, in case 0 was asked for
+        self.address = self._listener.address
+        self._thread = threading.Thread(target=self._serve_forever, name='scoring-broker', daemon=True)
+        self._thread.start()
+        logging.info(f"serving the scoring broker on {self.address[0]}:{self.address[1]}")
+
+    def stop(self):
+        if self._listener is None:
+            return
+        self._stopping.set()
+        # wakes up accept
+        host, port = self.address
+        try:
+            Client((host if host not in ('', '0.0.0.0') else '127.0.0.1', port), authkey=self.authkey).close()
+        except OSError:
+            pass
+        self._thread.join()
+        self._listener = None
+
+    def _serve_forever(self):
+        try:
+            while not self._stopping.is_set():
+                try:
+                    connection = self._listener.accept()
+                except Exception as e:
+                    # e.g. a client with the wrong authkey
+                    logging.warning(f"scoring broker connection refused: {e}")
+                    continue
+                if self._stopping.is_set():
+                    connection.close()
+                    break
+                threading.Thread(target=self._serve, args=(connection,), name='scoring-broker-client', daemon=True).start()
+        finally:
+            self._listener.close()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    target, method, args = connection.recv()
+                except (EOFError, OSError):
+                    break
+
+                try:
+                    if method not in _REMOTE_METHODS.get(target, ()):
+                        raise ScoringBrokerError(f"no remote method {target}.{method}")
+                    response = ('result', getattr(self.targets[target], method)(*args))
+                except ScoringJobError as e:
+                    response = ('job error', str(e))
+                except Exception as e:
+                    logging.exception(f"scoring broker {target}.{method} failed")
+                    response = ('error', f'{type(e).__name__}: {e}')
+
+                try:
+                    connection.send(response)
+                except OSError:
+                    break
+            self.targets['broker'].close()
+
+
+class _BrokerClient:
+    """A connection per thread to a BrokerServer."""
+
+    def __init__(self, address, authkey, connect_timeout):
+        if not authkey:
+            raise ValueError("SCORING_BROKER_AUTHKEY is required to use a remote scoring broker")
+        self.address = _address(address)
+        self.authkey = authkey.encode()
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            deadline = time.monotonic() + self.connect_timeout
+            while True:
+                try:
+                    connection = Client(self.address, authkey=self.authkey)
+                    break
+                except ConnectionRefusedError:
+                    if time.monotonic() > deadline:
+                        raise ScoringBrokerError(f"no scoring broker on {self.address} after {self.connect_timeout}s") from None
+                    time.sleep(1)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, target, method, args):
+        connection = self._connect()
+        try:
+            connection.send((target, method, args))
+            return connection.recv()
+        except (EOFError, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+
+    def call(self, target, method, *args):
+        try:
+            response = self._request(target, method, args)
+        except (EOFError, OSError) as e:
+            # worker calls are safe to repeat, a claim whose answer was lost
+            # only holds its jobs until their lease runs out
+            logging.warning(f"lost the scoring broker on {self.address}: {e}, reconnecting")
+            try:
+                response = self._request(target, method, args)
+            except (EOFError, OSError) as e:
+                raise ScoringBrokerError(f"lost the scoring broker on {self.address}: {e}") from e
+
+        kind, value = response
+        if kind == 'job error':
+            raise ScoringJobError(value)
+        if kind == 'error':
+            raise ScoringBrokerError(f"scoring broker {target}.{method} failed: {value}")
+        return value
+
+    def close(self):
+        """Closes this thread's connection."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class _RemoteTarget:
+    def __init__(self, client, target):
+        self._client = client
+        self._target = target
+
+    def __getattr__(self, method):
+        if method not in _REMOTE_METHODS[self._target]:
+            raise AttributeError(f"{self._target}.{method} isn't served to remote workers")
+        return functools.partial(self._client.call, self._target, method)
+
+    def close(self):
+        self._client.close()
+
+
+class RemoteScoringBroker(_RemoteTarget):
+    """The worker methods of a ScoringBroker served by a BrokerServer."""
+
+    def __init__(self, client):
+        super().__init__(client, 'broker')
+
+
+class RemoteRecordingStore(_RemoteTarget):
+    """get and put of a RecordingStore served by a BrokerServer."""
+
+    def __init__(self, client):
+        super().__init__(client, 'recordings')
+
+
+def connect_broker(address=SCORING_BROKER_ADDRESS, authkey=SCORING_BROKER_AUTHKEY,
+                   connect_timeout=SCORING_BROKER_CONNECT_TIMEOUT_SECONDS):
+    """
+    Returns the (broker, recordings) a scoring worker uses: the bot's over
+    the network if address is set, else the local SQLite database and
+    recordings directory.
+    """
+    if not address:
+        return ScoringBroker(), RecordingStore()
+    client = _BrokerClient(address, authkey, connect_timeout)
+    return RemoteScoringBroker(client), RemoteRecordingStore(client)
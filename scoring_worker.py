@@ -0,0 +1,151 @@
+"""
+Scoring worker: takes jobs from the scoring queue (see scoring_jobs.py),
+analyzes, scores and joins recordings, and posts the results back.
+
+Run as many as needed, on the bot's host or, with SCORING_BROKER_ADDRESS
+set to the bot's SCORING_BROKER_LISTEN, on any other:
+
+    python scoring_worker.py
+
+Workers of one node can share the ASR model of a model_server.py process
+there by setting MODEL_SERVER_SOCKET, instead of each loading their own.
+
+The bot also starts SCORING_WORKERS of them itself, sharing a model server
+unless SCORING_MODEL_SERVER is off. SIGTERM or SIGINT stops claiming new
+jobs, jobs already claimed are finished first.
+"""
+
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from dotenv import load_dotenv
+
+from metrics import REGISTRY
+from model_server import ModelServerUnavailable
+from process_audio import complete_line, concatenate_audio, get_transcriber, normalizer, prepare_line, score_lines, transcribe_batch
+from reference_index import load_or_build_reference_index
+from scoring_jobs import CONCAT, LINE, SCORE, connect_broker
+from transcription_service import TranscriptionService
+
+load_dotenv()
+
+# jobs run at once by one worker, their transcriptions are batched together
+SCORING_WORKER_THREADS = int(os.getenv('SCORING_WORKER_THREADS') or 4)
+SCORING_POLL_MS = float(os.getenv('SCORING_POLL_MS') or 20)
+HEARTBEAT_SECONDS = 5
+
+
+class ScoringWorker:
+    """Claims jobs while it has free threads and runs them."""
+
+    def __init__(self, broker=None, recordings=None, threads=SCORING_WORKER_THREADS):
+        if broker is None or recordings is None:
+            broker, recordings = connect_broker()
+        self.broker = broker
+        self.recordings = recordings
+        self.threads = threads
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.transcription = TranscriptionService(transcribe_batch)
+        self.reference = {}
+        self._stopping = threading.Event()
+        self._last_heartbeat = 0.0
+
+    def stop(self, *args):
+        self._stopping.set()
+
+    def _heartbeat(self, ready, force=False):
+        now = time.monotonic()
+        if force or now - self._last_heartbeat >= HEARTBEAT_SECONDS:
+            self.broker.heartbeat(self.worker_id, ready)
+            self._last_heartbeat = now
+
+    def _reference_seconds(self, payload):
+        """The length of the line's slice of its reference track, silence trimmed, if known."""
+        lines = self.reference.get(payload.get('song_id'), {}).get('lines') or []
+        line = payload.get('line')
+        if line is None or line >= len(lines):
+            return None
+        return lines[line]['seconds']
+
+    def _analyze_line(self, payload):
+        key, features, audio = prepare_line(self.recordings.get(payload['recording']), self._reference_seconds(payload))
+        if audio is not None:
+            features = complete_line(key, features, self.transcription.submit(audio).result())
+        features['lyrics'] = normalizer(payload['lyrics'])
+        return features
+
+    def _score(self, payload):
+        line_features = self.broker.results(payload['line_jobs'])
+        reference = self.reference[payload['song_id']]
+        return score_lines(reference['features'], line_features, reference['lines'])
+
+    def _concatenate(self, payload):
+        recordings = [self.recordings.get(recording) for recording in payload['recordings']]
+        return {'recording': self.recordings.put(concatenate_audio(recordings))}
+
+    def _run_job(self, job):
+        handlers = {LINE: self._analyze_line, SCORE: self._score, CONCAT: self._concatenate}
+        try:
+            result = handlers[job['kind']](job['payload'])
+        except ModelServerUnavailable as e:
+            # the model server is being restarted, the job is retried once it is back
+            logging.warning(f"scoring job {job['id']} ({job['kind']}) put back in the queue: {e}")
+            self.broker.release(job['id'], self.worker_id)
+        except Exception as e:
+            logging.exception(f"scoring job {job['id']} ({job['kind']}) failed")
+            self.broker.fail(job['id'], self.worker_id, f'{type(e).__name__}: {e}')
+        else:
+            self.broker.complete(job['id'], self.worker_id, result)
+
+        # the bot merges what its workers recorded into the metrics it serves
+        recorded = REGISTRY.drain()
+        if any(recorded):
+            self.broker.post_metrics(recorded)
+
+    def run(self):
+        self._heartbeat(ready=False, force=True)
+        logging.info(f"scoring worker {self.worker_id} loading models")
+        get_transcriber()
+        self.reference = load_or_build_reference_index()
+        self._heartbeat(ready=True, force=True)
+        logging.info(f"scoring worker {self.worker_id} ready")
+
+        running = set()
+        try:
+            with ThreadPoolExecutor(self.threads, thread_name_prefix='scoring-job') as pool:
+                while not self._stopping.is_set():
+                    self._heartbeat(ready=True)
+
+                    free = self.threads - len(running)
+                    jobs = self.broker.claim(self.worker_id, free) if free else []
+                    running.update(pool.submit(self._run_job, job) for job in jobs)
+
+                    if not jobs:
+                        done, running = wait(running, timeout=SCORING_POLL_MS / 1000, return_when=FIRST_COMPLETED)
+                        if not done and not running:
+                            self._stopping.wait(SCORING_POLL_MS / 1000)
+                    else:
+                        running = {future for future in running if not future.done()}
+
+                logging.info(f"scoring worker {self.worker_id} finishing {len(running)} jobs")
+        finally:
+            self.transcription.shutdown()
+            self.broker.remove_worker(self.worker_id)
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    worker = ScoringWorker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+The song catalog: lyrics line by line, and the reference recording of each song.
+"""
+
+SONG_1 = [
+    {
+        'lyrics': 'Joy to the world, the Lord has come',
+    },
+    {
+        'lyrics': 'Let earth receive her King',
+    },
+    {
+        'lyrics': 'Let every heart prepare Him room',
+    },
+    {
+        'lyrics': 'And heaven and nature sing, and heaven and nature sing',
+    },
+    {
+        'lyrics': 'And heaven, and heaven and nature sing',
+    },
+    {
+        'lyrics': 'Joy to the earth, the Savior reigns',
+    },
+    {
+        'lyrics': 'Let men their songs employ',
+    },
+    {
+        'lyrics': 'While fields and floods, rocks, hills, and plains',
+    },
+    {
+        'lyrics': 'Repeat the sounding joy, repeat the sounding joy',
+    },
+    {
+        'lyrics': 'Repeat, repeat the sounding joy',
+    },
+    {
+        'lyrics': 'No more let sins and sorrows grow',
+    },
+    {
+        'lyrics': 'Nor thorns infest the ground',
+    },
+    {
+        'lyrics': 'He comes to make His blessings flow',
+    },
+    {
+        'lyrics': 'Far as the curse is found, far as the curse is found',
+    },
+    {
+        'lyrics': 'Far as, far as the curse is found',
+    },
+    {
+        'lyrics': 'He rules the world with truth and grace',
+    },
+    {
+        'lyrics': 'And makes the nations prove',
+    },
+    {
+        'lyrics': 'The glories of His righteousness',
+    },
+    {
+        'lyrics': 'And wonders of His love, and wonders of His love',
+    },
+    {
+        'lyrics': 'And wonders, wonders of His love',
+    },
+]
+
+SONG_2 = [
+    {
+        'lyrics': 'Silent night, holy night',
+    },
+    {
+        'lyrics': 'All is calm, all is bright',
+    },
+    {
+        'lyrics': 'Round yon Virgin, Mother and Child',
+    },
+    {
+        'lyrics': 'Holy Infant so tender and mild',
+    },
+    {
+        'lyrics': 'Sleep in heavenly peace',
+    },
+    {
+        'lyrics': 'Sleep in heavenly peace',
+    },
+]
+
+SONG_3 = [
+    {
+        'lyrics': 'Dashing through the snow',
+    },
+    {
+        'lyrics': 'In a one-horse open sleigh',
+    },
+    {
+        'lyrics': 'All the fields we go',
+    },
+    {
+        'lyrics': 'Laughing all the way',
+    },
+    {
+        'lyrics': 'Bells on bobtails ring',
+    },
+    {
+        'lyrics': 'Making spirits bright',
+    },
+    {
+        'lyrics': 'What fun it is to ride and sing',
+    },
+    {
+        'lyrics': 'A sleighing song tonight',
+    },
+    {
+        'lyrics': 'Oh! Jingle bells, jingle bells',
+    },
+    {
+        'lyrics': 'Jingle all the way',
+    },
+    {
+        'lyrics': 'Oh, what fun it is to ride',
+    },
+    {
+        'lyrics': 'In a one-horse open sleigh, hey',
+    },
+    {
+        'lyrics': 'Jingle bells, jingle bells',
+    },
+    {
+        'lyrics': 'Jingle all the way',
+    },
+    {
+        'lyrics': 'Oh, what fun it is to ride',
+    },
+    {
+        'lyrics': 'In a one-horse open sleigh',
+    },
+]
+
+SONG_4 = [
+    {
+        'lyrics': 'Jingle bells, jingle bells',
+    },
+    {
+        'lyrics': 'Jingle all the way',
+    },
+    {
+        'lyrics': 'Oh, what fun it is to ride',
+    },
+    {
+        'lyrics': 'In a one-horse open sleigh, hey',
+    },
+    {
+        'lyrics': 'Jingle bells, jingle bells',
+    },
+    {
+        'lyrics': 'Jingle all the way',
+    },
+    {
+        'lyrics': 'Oh, what fun it is to ride',
+    },
+    {
+        'lyrics': 'In a one-horse open sleigh',
+    },
+]
+
+SONG_5 = [
+    {
+        'lyrics': 'You are my fire',
+    },
+    {
+        'lyrics': 'The one desire',
+    },
+    {
+        'lyrics': 'Believe when I say',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': 'But we are two worlds apart',
+    },
+    {
+        'lyrics': 'Can\'t reach to your heart',
+    },
+    {
+        'lyrics': 'When you say',
+    },
+    {
+        'lyrics': 'That I want it that way',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a heartache',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a mistake',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'I never wanna hear you say',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': 'Am I your fire',
+    },
+    {
+        'lyrics': 'Your one desire',
+    },
+    {
+        'lyrics': 'Yes I know it\'s too late',
+    },
+    {
+        'lyrics': 'But I want it that way',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a heartache',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a mistake',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'I never wanna hear you say',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': 'Now I can see that we\'re falling apart',
+    },
+    {
+        'lyrics': 'From the way that it used to be, yeah',
+    },
+    {
+        'lyrics': 'No matter the distance',
+    },
+    {
+        'lyrics': 'I want you to know',
+    },
+    {
+        'lyrics': 'That deep down inside of me',
+    },
+    {
+        'lyrics': 'You are my fire',
+    },
+    {
+        'lyrics': 'The one desire',
+    },
+    {
+        'lyrics': 'You are',
+    },
+    {
+        'lyrics': 'You are, you are, you are',
+    },
+    {
+        'lyrics': 'Don\'t wanna hear you say',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a heartache',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a mistake (don\'t wanna hear you say)',
+    },
+    {
+        'lyrics': 'I never wanna hear you say (oh, yeah)',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a heartache',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a mistake',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'I never wanna hear you say (don\'t wanna hear you say)',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a heartache',
+    },
+    {
+        'lyrics': 'Ain\'t nothing but a mistake',
+    },
+    {
+        'lyrics': 'Tell me why',
+    },
+    {
+        'lyrics': 'I never wanna hear you say (never wanna hear you say)',
+    },
+    {
+        'lyrics': 'I want it that way',
+    },
+    {
+        'lyrics': '\'Cause I want it that way',
+    },
+]
+
+SONGS = {
+    'Joy to the world': SONG_1,
+    'Silent Night': SONG_2,
+    'Jingle Bells': SONG_3,
+    'Jingle Bells (chorus)': SONG_4,
+    'I want it that way': SONG_5,
+}
+
+SONG_REFERENCES = {
+    'Joy to the world': 'data/mp3/joytotheworld.mp3',
+    'Silent Night': 'data/mp3/silentnight.mp3',
+    'Jingle Bells': 'data/mp3/jinglebells.mp3',
+    'Jingle Bells (chorus)': 'data/mp3/jinglebellschorus.mp3',
+    'I want it that way': 'data/mp3/iwantitthatway.mp3',
+}
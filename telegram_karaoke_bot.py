@@ -6,26 +6,55 @@
 Telegram Karaoke Bot to score performances and reward with nfts.
 """
 
+import asyncio
+import functools
+import hashlib
+import hmac
+import html
 import io
+import json
 import logging
 import os
 import re
+import signal
 
 from dotenv import load_dotenv
 import prettytable as pt
-import whisper
 
 from telegram import ForceReply, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import Application, CallbackContext, CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, filters
+from telegram.ext import Application, BaseUpdateProcessor, CallbackContext, CallbackQueryHandler, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, PicklePersistence, filters
 from telegram.constants import ParseMode
 
-from contract_interaction import call_contract_mint
-from generate_nft import create_upload_nft
-from process_audio import concatenate_audio, compare_audios
+from http_server import HttpServer
+from leaderboard import Leaderboard
+from metrics import cache_hit_rate, metrics_endpoint, REGISTRY, timed
+from nft_jobs import DONE, NftJobQueue
+from scoring_executor import ScoringExecutor
+from scoring_jobs import ScoringJobError
+from songs import SONGS
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN') or ''
+# Conversations, wallets and games are saved here if set, so the bot can be
+# restarted or replaced without losing the games being played
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE') or ''
+# Telegram user ids allowed to use /stats, comma separated
+ADMIN_USER_IDS = {int(user_id) for user_id in (os.getenv('ADMIN_USER_IDS') or '').split(',') if user_id.strip()}
+
+# 'polling', or 'webhook' to take the updates Telegram posts to WEBHOOK_PATH on
+# the HTTP port. The webhook is registered with Telegram at startup if
+# WEBHOOK_URL (the public base URL) is set, otherwise it is only served.
+UPDATE_MODE = os.getenv('UPDATE_MODE') or 'polling'
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or ''
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or '/telegram'
+# Required in webhook mode, Telegram sends it with every update
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN') or ''
+# How long a shutdown waits for the updates already taken to be handled
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv('SHUTDOWN_DRAIN_SECONDS') or 25)
+
+# The bot only handles commands, voice messages and song picks
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Enable logging
 logging.basicConfig(
@@ -45,7 +74,8 @@ logger = logging.getLogger(__name__)
 #     game_id: <user_id> -> {
 #       song_id: <song_id>
 #       song_index: number
-#       recordings: ['filenames.ogg'...]
+#       recordings: [recording hashes...]
+#       line_jobs: [scoring job ids...]
 #       score: number
 #     }
 #   }
@@ -63,7 +93,8 @@ _USER_DATA_WALLET_KEY = 'wallet_addrs'
 _USER_DATA_GAME_KEY = 'games'
 _USER_DATA_LEADERBOARD_KEY = 'leaderboard'
 
-_LEADERBOARD = []
+# Global and per song top scores, persisted to disk
+_LEADERBOARD = Leaderboard()
 
 # Disable minting nfts (to save test coins)
 _SKIP_NFT = False
@@ -71,350 +102,18 @@ _SKIP_NFT = False
 #TXN_SCAN_URL = 'https://sepolia.etherscan.io/tx/'
 TXN_SCAN_URL = 'https://opbnb-testnet.bscscan.com/tx/'
 
-SONG_SELECTION, LYRICS, SCORE = range(3)
+# Scoring runs in scoring workers, possibly on other nodes, the bot only
+# queues jobs and waits for their results
+_SCORING_EXECUTOR = ScoringExecutor()
+
+# NFTs are rendered, uploaded and minted in the background, the bot messages
+# the player once done. Started in post_init.
+_NFT_JOBS = None
 
-SONG_1 = [
-    {
-        'lyrics': 'Joy to the world, the Lord has come',
-    },
-    {
-        'lyrics': 'Let earth receive her King',
-    },
-    {
-        'lyrics': 'Let every heart prepare Him room',
-    },
-    {
-        'lyrics': 'And heaven and nature sing, and heaven and nature sing',
-    },
-    {
-        'lyrics': 'And heaven, and heaven and nature sing',
-    },
-    {
-        'lyrics': 'Joy to the earth, the Savior reigns',
-    },
-    {
-        'lyrics': 'Let men their songs employ',
-    },
-    {
-        'lyrics': 'While fields and floods, rocks, hills, and plains',
-    },
-    {
-        'lyrics': 'Repeat the sounding joy, repeat the sounding joy',
-    },
-    {
-        'lyrics': 'Repeat, repeat the sounding joy',
-    },
-    {
-        'lyrics': 'No more let sins and sorrows grow',
-    },
-    {
-        'lyrics': 'Nor thorns infest the ground',
-    },
-    {
-        'lyrics': 'He comes to make His blessings flow',
-    },
-    {
-        'lyrics': 'Far as the curse is found, far as the curse is found',
-    },
-    {
-        'lyrics': 'Far as, far as the curse is found',
-    },
-    {
-        'lyrics': 'He rules the world with truth and grace',
-    },
-    {
-        'lyrics': 'And makes the nations prove',
-    },
-    {
-        'lyrics': 'The glories of His righteousness',
-    },
-    {
-        'lyrics': 'And wonders of His love, and wonders of His love',
-    },
-    {
-        'lyrics': 'And wonders, wonders of His love',
-    },
-]
-
-SONG_2 = [
-    {
-        'lyrics': 'Silent night, holy night',
-    },
-    {
-        'lyrics': 'All is calm, all is bright',
-    },
-    {
-        'lyrics': 'Round yon Virgin, Mother and Child',
-    },
-    {
-        'lyrics': 'Holy Infant so tender and mild',
-    },
-    {
-        'lyrics': 'Sleep in heavenly peace',
-    },
-    {
-        'lyrics': 'Sleep in heavenly peace',
-    },
-]
-
-SONG_3 = [
-    {
-        'lyrics': 'Dashing through the snow',
-    },
-    {
-        'lyrics': 'In a one-horse open sleigh',
-    },
-    {
-        'lyrics': 'All the fields we go',
-    },
-    {
-        'lyrics': 'Laughing all the way',
-    },
-    {
-        'lyrics': 'Bells on bobtails ring',
-    },
-    {
-        'lyrics': 'Making spirits bright',
-    },
-    {
-        'lyrics': 'What fun it is to ride and sing',
-    },
-    {
-        'lyrics': 'A sleighing song tonight',
-    },
-    {
-        'lyrics': 'Oh! Jingle bells, jingle bells',
-    },
-    {
-        'lyrics': 'Jingle all the way',
-    },
-    {
-        'lyrics': 'Oh, what fun it is to ride',
-    },
-    {
-        'lyrics': 'In a one-horse open sleigh, hey',
-    },
-    {
-        'lyrics': 'Jingle bells, jingle bells',
-    },
-    {
-        'lyrics': 'Jingle all the way',
-    },
-    {
-        'lyrics': 'Oh, what fun it is to ride',
-    },
-    {
-        'lyrics': 'In a one-horse open sleigh',
-    },
-]
-
-SONG_4 = [
-    {
-        'lyrics': 'Jingle bells, jingle bells',
-    },
-    {
-        'lyrics': 'Jingle all the way',
-    },
-    {
-        'lyrics': 'Oh, what fun it is to ride',
-    },
-    {
-        'lyrics': 'In a one-horse open sleigh, hey',
-    },
-    {
-        'lyrics': 'Jingle bells, jingle bells',
-    },
-    {
-        'lyrics': 'Jingle all the way',
-    },
-    {
-        'lyrics': 'Oh, what fun it is to ride',
-    },
-    {
-        'lyrics': 'In a one-horse open sleigh',
-    },
-]
-
-SONG_5 = [
-    {
-        'lyrics': 'You are my fire',
-    },
-    {
-        'lyrics': 'The one desire',
-    },
-    {
-        'lyrics': 'Believe when I say',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': 'But we are two worlds apart',
-    },
-    {
-        'lyrics': 'Can\'t reach to your heart',
-    },
-    {
-        'lyrics': 'When you say',
-    },
-    {
-        'lyrics': 'That I want it that way',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a heartache',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a mistake',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'I never wanna hear you say',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': 'Am I your fire',
-    },
-    {
-        'lyrics': 'Your one desire',
-    },
-    {
-        'lyrics': 'Yes I know it\'s too late',
-    },
-    {
-        'lyrics': 'But I want it that way',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a heartache',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a mistake',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'I never wanna hear you say',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': 'Now I can see that we\'re falling apart',
-    },
-    {
-        'lyrics': 'From the way that it used to be, yeah',
-    },
-    {
-        'lyrics': 'No matter the distance',
-    },
-    {
-        'lyrics': 'I want you to know',
-    },
-    {
-        'lyrics': 'That deep down inside of me',
-    },
-    {
-        'lyrics': 'You are my fire',
-    },
-    {
-        'lyrics': 'The one desire',
-    },
-    {
-        'lyrics': 'You are',
-    },
-    {
-        'lyrics': 'You are, you are, you are',
-    },
-    {
-        'lyrics': 'Don\'t wanna hear you say',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a heartache',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a mistake (don\'t wanna hear you say)',
-    },
-    {
-        'lyrics': 'I never wanna hear you say (oh, yeah)',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a heartache',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a mistake',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'I never wanna hear you say (don\'t wanna hear you say)',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a heartache',
-    },
-    {
-        'lyrics': 'Ain\'t nothing but a mistake',
-    },
-    {
-        'lyrics': 'Tell me why',
-    },
-    {
-        'lyrics': 'I never wanna hear you say (never wanna hear you say)',
-    },
-    {
-        'lyrics': 'I want it that way',
-    },
-    {
-        'lyrics': '\'Cause I want it that way',
-    },
-]
-
-SONGS = {
-    'Joy to the world': SONG_1,
-    'Silent Night': SONG_2,
-    'Jingle Bells': SONG_3,
-    'Jingle Bells (chorus)': SONG_4,
-    'I want it that way': SONG_5,
-}
-
-SONG_REFERENCES = {
-    'Joy to the world': 'data/mp3/joytotheworld.mp3',
-    'Silent Night': 'data/mp3/silentnight.mp3',
-    'Jingle Bells': 'data/mp3/jinglebells.mp3',
-    'Jingle Bells (chorus)': 'data/mp3/jinglebellschorus.mp3',
-    'I want it that way': 'data/mp3/iwantitthatway.mp3',
-}
+# Serves /metrics, and the webhook in webhook mode. Started in post_init.
+_HTTP_SERVER = HttpServer()
+
+SONG_SELECTION, LYRICS, SCORE = range(3)
 
 
 # Define a few command handlers. These usually take the two arguments update and
@@ -438,6 +137,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text('Pick a tune that makes your soul sing!', reply_markup=reply_markup)
 
+    if not _SCORING_EXECUTOR.ready.is_set():
+        await update.message.reply_text("Our judges are still warming up, your score might take a little longer than usual.")
+
     return SONG_SELECTION
 
 async def song_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -457,10 +159,12 @@ async def song_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if _USER_DATA_GAME_KEY not in context.user_data:
         context.user_data[_USER_DATA_GAME_KEY] = {}
 
+    await _cancel_line_analyses(context, user_id)
     context.user_data[_USER_DATA_GAME_KEY][user_id] = {
         'song_id': selected_song,
         'song_index': 0,
         'recordings': [],
+        'line_jobs': [],
         'score': 0,
     }
 
@@ -482,7 +186,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     3\. Choose Your Tunes\! Select a song from our awesome library\.
     4\. Showtime\! When the lyric appears, record your most fabulous voice message\.
     5\. 🌟 Rock the Scoreboard\! 🌟 Earn a score and unlock exclusive NFTs to show off your vocal prowess\!
-    6\. Checkout the leaderboard\! Use '/leaderboard' to see the highscores\.
+    6\. Checkout the leaderboard\! Use '/leaderboard' to see the highscores, or '/leaderboard <song\>' for one song\.
     7\. Cancel anytime\! Use '/cancel' to abort the current game\.
 
     Scoring:
@@ -526,10 +230,13 @@ async def get_wallet_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 
 async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message when the command /leaderboard is issued."""
-    scores = _LEADERBOARD
+    """Send a message when the command /leaderboard [song] is issued."""
+    song_id = ' '.join(context.args).strip() or None
+    if song_id is not None and song_id not in SONGS:
+        await update.message.reply_text(f"Unknown song. Try one of: {', '.join(SONGS)}")
+        return
 
-    scores = sorted(scores, key=lambda s: s['score'], reverse=True)
+    scores = _LEADERBOARD.top(song_id)
 
     table = pt.PrettyTable(['Score', 'Song', 'Player'])
     table.align['Score'] = 'l'
@@ -539,7 +246,44 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     for score in scores:
         table.add_row([f"{score['score']:06}", score['song_id'], score['username']])
 
-    await update.message.reply_text(f'<pre>{table}</pre>', parse_mode=ParseMode.HTML)
+    message = f'<pre>{html.escape(str(table))}</pre>'
+
+    rank = _LEADERBOARD.rank(update.effective_user.id, song_id)
+    if rank:
+        position, best = rank
+        message += f'\nYour best: {best:06}, rank {position} of {_LEADERBOARD.games(song_id)}'
+
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a summary of stage latencies, queue depths and cache hit rates when an admin issues /stats."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("Sorry, /stats is for admins only.")
+        return
+
+    table = pt.PrettyTable(['Stage', 'Count', 'p50 ms', 'p95 ms', 'Mean ms'])
+    table.align = 'r'
+    table.align['Stage'] = 'l'
+    for stage, histogram in REGISTRY.stages().items():
+        table.add_row([
+            stage,
+            histogram.count,
+            f"{histogram.quantile(0.5) * 1000:.0f}",
+            f"{histogram.quantile(0.95) * 1000:.0f}",
+            f"{histogram.sum / histogram.count * 1000:.0f}",
+        ])
+
+    lines = [f'{name}: {value}' for name, value in REGISTRY.gauges().items()]
+    for cache in ('audio_features', 'lyrics'):
+        rate = cache_hit_rate(cache)
+        lines.append(f"{cache} cache hit rate: {'n/a' if rate is None else f'{rate:.0%}'}")
+    sung_seconds = REGISTRY.counter('karaoke_vad_input_seconds_total')
+    if sung_seconds:
+        removed = REGISTRY.counter('karaoke_vad_removed_seconds_total')
+        lines.append(f"silence trimmed: {removed:.0f}s of {sung_seconds:.0f}s ({removed / sung_seconds:.0%})")
+
+    message = f'<pre>{html.escape(str(table))}</pre>\n' + html.escape('\n'.join(lines))
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Echo the user message."""
@@ -550,6 +294,7 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = update.message.from_user
 
     logger.info("User %s canceled the conversation.", user.first_name)
+    await _cancel_line_analyses(context, update.effective_user.id)
 
     await update.message.reply_text(
         "Bye! I hope we can talk again some day.", reply_markup=ReplyKeyboardRemove()
@@ -563,6 +308,7 @@ async def process_lyrics(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     #     'song_id': selected_song,
     #     'song_index': 0,
     #     'recordings': [],
+    #     'line_jobs': [],
     #     'score': 0,
     # }
     user_id = update.effective_user.id
@@ -572,43 +318,71 @@ async def process_lyrics(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     voice = update.message.voice
     voice_file = await context.bot.get_file(voice.file_id)
 
-    f = await voice_file.download_to_drive(f'{voice.file_id}.ogg')
-    game_info['recordings'].append(f'{voice.file_id}.ogg')
-    game_info['song_index'] += 1
+    with timed('download'):
+        recording = bytes(await voice_file.download_as_bytearray())
+    recording = await _SCORING_EXECUTOR.store_recording(recording)
+    game_info['recordings'].append(recording)
 
     song = SONGS[game_info['song_id']]
 
+    # a scoring worker analyzes the line while the next one is sung
+    game_info['line_jobs'].append(await _SCORING_EXECUTOR.analyze_line(
+        recording, song[game_info['song_index']]['lyrics'], game_info['song_id'], game_info['song_index'],
+    ))
+    game_info['song_index'] += 1
+
     if game_info['song_index'] >= len(song):
-        await score_performance(update, context)
+        # Scored in the background, so this handler returns and the user's
+        # other updates, e.g. /leaderboard, aren't held up behind the score.
+        # The game is taken out of user_data, a new one doesn't cancel its jobs.
+        del context.user_data[_USER_DATA_GAME_KEY][user_id]
+        context.application.create_task(score_performance(update, context, game_info), update=update)
         return ConversationHandler.END
 
     await update.message.reply_text(f"{song[game_info['song_index']]['lyrics']}")
 
     return LYRICS
 
-async def score_performance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Scores the whole performance."""
+async def _cancel_line_analyses(context, user_id):
+    """Drops the line analyses of a user's previous game."""
+    game_info = context.user_data.get(_USER_DATA_GAME_KEY, {}).get(user_id)
+    if game_info:
+        await _SCORING_EXECUTOR.cancel(game_info.get('line_jobs', []))
+
+async def score_performance(update: Update, context: ContextTypes.DEFAULT_TYPE, game_info: dict) -> None:
+    """Scores the whole performance of a finished game."""
     await update.message.reply_text(f"You rocked it! Scoring your performance now...")
 
     user_id = update.effective_user.id
-    game_info = context.user_data[_USER_DATA_GAME_KEY][user_id]
 
-    # concatenate all audio files together
-    logging.info(f"concatenate song lines")
-    concatenated_song, concatenated_filename = concatenate_audio(game_info['recordings'])
-    logging.info(f"concat done")
-
-    # score the performance
-    score = compare_audios(SONG_REFERENCES[game_info['song_id']], concatenated_filename)
+    # most lines were analyzed while the user was singing, only the last ones are pending
+    logging.info(f"scoring song lines")
+    try:
+        score, concatenated_song = await asyncio.gather(
+            _SCORING_EXECUTOR.score_lines(game_info['song_id'], game_info['line_jobs']),
+            _SCORING_EXECUTOR.concatenate_recordings(game_info['recordings']),
+        )
+    except ScoringJobError as e:
+        # the game ends either way, the player starts over with /start
+        logging.warning(f"scoring the performance of {user_id} failed: {e}")
+        await _SCORING_EXECUTOR.cancel(game_info['line_jobs'])
+        await update.message.reply_text("Sorry, we couldn't score your performance this time. Try again with /start!")
+        return
+    logging.info(f"scoring done")
     await update.message.reply_text(f"Your Score: {score}")
 
-    await update.message.reply_audio(concatenated_song, caption='Your whole performance')
+    await update.message.reply_audio(
+        concatenated_song,
+        filename='performance.ogg',
+        caption='Your whole performance',
+    )
 
 
-    _LEADERBOARD.append({
+    _LEADERBOARD.add({
         'score': score,
         'song_id': game_info['song_id'],
         'username': update.message.from_user.first_name,
+        'user_id': user_id,
     })
 
     # mint the nft
@@ -620,38 +394,201 @@ async def score_performance(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not addr:
         logging.info(f"user wallet not yet registered")
         await update.message.reply_text("No wallets registered yet. Please use command: /register 0x...")
+        return
 
-    logging.info(f"generating nft image and metadata")
-    json_cid = create_upload_nft(score, game_info['song_id'])
+    # render, upload and mint in the background, the same performance is only minted once
+    game_key = hashlib.sha256(''.join(game_info['recordings']).encode()).hexdigest()
+    logging.info(f"queueing nft job {game_key}")
+    _NFT_JOBS.enqueue(f"{user_id}:{game_key}", update.effective_chat.id, score, game_info['song_id'], addr)
+    await update.message.reply_text("Your NFT is on its way! I'll message you once it's minted.")
 
-    logging.info(f"minting nft for {json_cid}")
-    receipt = call_contract_mint(addr, f"ipfs://{json_cid}")
 
-    if receipt:
-        txn_hash = receipt['transactionHash'].to_0x_hex()
-        logging.info(f"minting nft receipt tx: {txn_hash}")
-        await update.message.reply_text(
-            f"""You just earned a shiny NFT\! Check it out here:
+async def nft_job_completed(bot, job) -> None:
+    """Tells the player their NFT was minted, or that minting failed."""
+    if job['status'] != DONE:
+        await bot.send_message(
+            job['chat_id'], "Sorry, we couldn't mint your NFT this time. Your score is safe on the leaderboard!",
+        )
+        return
+
+    txn_hash = job['txn_hash']
+    logging.info(f"minting nft receipt tx: {txn_hash}")
+    token = f" \\#{job['token_id']}" if job.get('token_id') is not None else ''
+    await bot.send_message(
+        job['chat_id'],
+        f"""You just earned a shiny NFT{token}\! Check it out here:
 
 [https://dub\.sh/tgkaraokesite](https://dub.sh/tgkaraokesite)
 
 [Txn: {txn_hash}]({TXN_SCAN_URL}{txn_hash})
         """,
-            parse_mode=ParseMode.MARKDOWN_V2,
-        )
+        parse_mode=ParseMode.MARKDOWN_V2,
+    )
 
 
+async def post_init(application: Application) -> None:
+    """
+    Starts the local scoring workers and resumes nft jobs in the background, so
+    polling starts right away, and starts serving metrics.
+    """
+    global _NFT_JOBS
+    _SCORING_EXECUTOR.warm_up()
+
+    _NFT_JOBS = NftJobQueue(on_complete=functools.partial(nft_job_completed, application.bot))
+    _NFT_JOBS.start()
+
+    REGISTRY.gauge(
+        'karaoke_scoring_jobs_queued', 'Scoring jobs no worker has claimed yet.', _SCORING_EXECUTOR.queued_count,
+    )
+    REGISTRY.gauge(
+        'karaoke_scoring_workers_ready', 'Scoring workers up with their models loaded.',
+        _SCORING_EXECUTOR.ready_workers,
+    )
+    REGISTRY.gauge('karaoke_nft_jobs_pending', 'NFT jobs not done or failed yet.', _NFT_JOBS.pending_count)
+    _HTTP_SERVER.route('GET', '/metrics', metrics_endpoint)
+    await _HTTP_SERVER.start()
+
+
+async def post_shutdown(application: Application) -> None:
+    """Stops the scoring workers, nft jobs and HTTP server once the bot is shutting down."""
+    await _HTTP_SERVER.stop()
+    if _NFT_JOBS is not None:
+        await _NFT_JOBS.stop()
+    await _SCORING_EXECUTOR.shutdown()
+
+
+async def receive_update(application: Application, request) -> tuple:
+    """Queues an update Telegram posted to the webhook."""
+    secret_token = request.headers.get('x-telegram-bot-api-secret-token', '')
+    if not hmac.compare_digest(secret_token, WEBHOOK_SECRET_TOKEN):
+        return 403, b'forbidden\n', 'text/plain'
+
+    # Telegram redelivers updates it couldn't post, e.g. to another replica
+    if not application.running:
+        return 503, b'shutting down\n', 'text/plain'
+
+    try:
+        body = json.loads(request.body)
+        if not isinstance(body, dict):
+            return 400, b'bad update\n', 'text/plain'
+        update = Update.de_json(body, application.bot)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return 400, b'bad update\n', 'text/plain'
+
+    await application.update_queue.put(update)
+    return 200, b'', 'text/plain'
+
+
+async def run_webhook(application: Application) -> None:
+    """
+    Handles the updates posted to WEBHOOK_PATH until SIGINT or SIGTERM.
+
+    On shutdown the HTTP server stops first, so Telegram retries new updates
+    elsewhere, then the updates already taken are handled for up to
+    SHUTDOWN_DRAIN_SECONDS.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    _HTTP_SERVER.route('POST', WEBHOOK_PATH, functools.partial(receive_update, application))
+
+    await application.initialize()
+    try:
+        await post_init(application)
+        await application.start()
+
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=WEBHOOK_SECRET_TOKEN,
+            )
+        logging.info(f"taking updates on {WEBHOOK_PATH}")
+
+        await stop.wait()
+    finally:
+        logging.info("draining in-flight updates")
+        await _HTTP_SERVER.stop()
+        if application.running:
+            try:
+                await asyncio.wait_for(application.stop(), timeout=SHUTDOWN_DRAIN_SECONDS)
+            except asyncio.TimeoutError:
+                logging.warning(f"updates still running after {SHUTDOWN_DRAIN_SECONDS}s, shutting down anyway")
+        await application.shutdown()
+        await post_shutdown(application)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes the updates of each user one at a time and in order, as the
+    karaoke ConversationHandler requires, and those of different users
+    concurrently. Handlers leave long waits, like scoring, to tasks of their
+    own, so a user's next updates aren't held up behind them.
+    """
+
+    def __init__(self, max_concurrent_updates=256):
+        super().__init__(max_concurrent_updates)
+        # user or chat id -> [lock, updates holding or waiting for it]
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = getattr(update, 'effective_user', None)
+        chat = getattr(update, 'effective_chat', None)
+        key = user.id if user else chat.id if chat else None
+        if key is None:
+            await coroutine
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 
 def main() -> None:
     """Start the bot."""
+    if UPDATE_MODE == 'webhook' and not WEBHOOK_SECRET_TOKEN:
+        # anyone who finds WEBHOOK_PATH could post updates otherwise
+        raise SystemExit("UPDATE_MODE=webhook requires WEBHOOK_SECRET_TOKEN")
+
+    _LEADERBOARD.load()
+
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Each user's updates are processed in order, so one user's scoring doesn't
+    # hold up the others but their own voice messages are never handled out of order.
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if UPDATE_MODE == 'webhook':
+        # updates arrive through _HTTP_SERVER instead
+        builder = builder.updater(None)
+    if PERSISTENCE_FILE:
+        builder = builder.persistence(PicklePersistence(PERSISTENCE_FILE))
+    application = builder.build()
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("register", register_wallet_command))
     application.add_handler(CommandHandler("current_wallet", get_wallet_command))
     application.add_handler(CommandHandler("leaderboard", show_leaderboard))
+    application.add_handler(CommandHandler("stats", show_stats))
 
     # Karaoke game state handlers
     karaoke_handler = ConversationHandler(
@@ -661,12 +598,17 @@ def main() -> None:
             LYRICS: [MessageHandler(filters.VOICE, process_lyrics)],
         },
         fallbacks = [CommandHandler('cancel', cancel)],
+        name='karaoke',
+        persistent=bool(PERSISTENCE_FILE),
     )
     application.add_handler(karaoke_handler)
 
 
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if UPDATE_MODE == 'webhook':
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == "__main__":
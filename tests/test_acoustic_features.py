@@ -0,0 +1,38 @@
+"""
+Pins process_audio.acoustic_features on a fixed synthetic line, so a change
+to the STFT, pitch tracking or tempo estimation that moves scores shows up.
+The values were computed with librosa 0.11.
+"""
+
+import numpy as np
+import pytest
+
+from process_audio import SAMPLE_RATE, acoustic_features
+
+
+@pytest.fixture(scope='module')
+def features():
+    # a 440 Hz tone, on for a quarter second every half second, over faint noise
+    rng = np.random.default_rng(0)
+    t = np.arange(4 * SAMPLE_RATE) / SAMPLE_RATE
+    gate = (t % 0.5) < 0.25
+    y = 0.5 * np.sin(2 * np.pi * 440 * t) * gate + 0.01 * rng.standard_normal(len(t))
+    return acoustic_features(y.astype(np.float32))
+
+
+def test_duration(features):
+    assert features['duration'] == 4.0
+
+
+def test_tempo(features):
+    # 120 bpm of onsets, on librosa's tempo grid
+    assert features['bpm'] == pytest.approx(117.1875, abs=1.0)
+
+
+def test_pitch(features):
+    assert len(features['pitch_bins']) == 1025
+    # the bin holding the tone
+    assert features['pitch_bins'][56] == pytest.approx(440.09, abs=1.0)
+    assert features['average_pitch'] == pytest.approx(2077.28, rel=1e-3)
+    assert features['pitch_track'] == pytest.approx(52237.36, rel=1e-3)
+    assert features['pitch_range'] == pytest.approx(492, abs=2)
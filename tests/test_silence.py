@@ -0,0 +1,29 @@
+import numpy as np
+
+from process_audio import SAMPLE_RATE, is_silent
+
+
+def _noise_floor(seconds, rng):
+    # about -70 dBFS
+    return 0.0003 * rng.standard_normal(int(seconds * SAMPLE_RATE)).astype(np.float32)
+
+
+def test_silence_with_a_click_is_silent():
+    rng = np.random.default_rng(0)
+    y = _noise_floor(3, rng)
+    # a full scale click, a few samples long
+    y[SAMPLE_RATE:SAMPLE_RATE + 8] = 1.0
+    assert is_silent(y)
+
+
+def test_sung_line_is_not_silent():
+    rng = np.random.default_rng(0)
+    y = _noise_floor(3, rng)
+    t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+    # a second of a quiet tone, about -30 dBFS
+    y[SAMPLE_RATE:2 * SAMPLE_RATE] += 0.03 * np.sin(2 * np.pi * 220 * t)
+    assert not is_silent(y)
+
+
+def test_empty_audio_is_silent():
+    assert is_silent(np.zeros(0, dtype=np.float32))
@@ -0,0 +1,104 @@
+"""
+Micro-batching front end for the ASR transcriber (see asr_backends.py).
+
+Clips from concurrent games are queued and run through the model together,
+up to a maximum batch size, waiting at most a few milliseconds for a batch
+to fill up.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRANSCRIBE_MAX_BATCH = int(os.getenv('TRANSCRIBE_MAX_BATCH') or 8)
+TRANSCRIBE_MAX_WAIT_MS = float(os.getenv('TRANSCRIBE_MAX_WAIT_MS') or 50)
+
+
+class TranscriptionService:
+    """
+    Runs transcribe_batch on queued clips from a single background thread.
+
+    transcribe_batch: takes a list of decoded clips, returns their texts in order.
+    """
+
+    def __init__(self, transcribe_batch, max_batch_size=TRANSCRIBE_MAX_BATCH, max_wait=TRANSCRIBE_MAX_WAIT_MS / 1000):
+        self.transcribe_batch = transcribe_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='transcription-service', daemon=True)
+                self._thread.start()
+
+    def submit(self, audio):
+        """Queues a decoded clip, returns a concurrent.futures.Future of its text."""
+        self.start()
+        future = Future()
+        self._queue.put((audio, future))
+        return future
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+
+            # drop clips whose callers stopped waiting
+            batch = [(audio, future) for audio, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            logging.info(f"transcribing a batch of {len(batch)} clips")
+            try:
+                texts = self.transcribe_batch([audio for audio, _ in batch])
+            except Exception as e:
+                logging.exception("batch transcription failed")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for (_, future), text in zip(batch, texts):
+                future.set_result(text)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            if wait:
+                thread.join()